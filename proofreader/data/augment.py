@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 from proofreader.utils.data import random_sample_arr
 
 """
@@ -12,24 +13,67 @@ class Augmentor(object):
                  center: bool = False,
                  random_scale: bool = False,
                  num_points: int = None,
-                 normalize: tuple = [125, 1250, 1250]
+                 normalize: tuple = [125, 1250, 1250],
+                 rotate_z: bool = False,
+                 perturb_rotation: bool = False,
+                 jitter: bool = False,
+                 fps_order: bool = False,
                  ):
         """
         Used to augment single pointcloud example
+        normalize, center, random scale and rotations are combined into one affine transform, applied in a single matmul.
+        Every random parameter of an example comes from its seed, DatasetWithInfo derives it from (dataset seed, epoch, index)
+        with augment_seed so any example can be reproduced with transfrom(data, seed=...) without logging anything.
+        fps_order: points are stored in farthest point order (see SliceDataset fps_points), sampling takes the
+                   first num_points and points are never shuffled so the order carries through to the model.
         """
         self.shuffle = shuffle
         self.center = center
         self.random_scale = random_scale
         self.normalize = normalize
         self.num_points = num_points
+        self.rotate_z = rotate_z
+        self.perturb_rotation = perturb_rotation
+        self.jitter = jitter
+        self.fps_order = fps_order
+        self.last_params = None
 
-    def __call__(self, data):
-        return self.transfrom(data)
+    def __call__(self, data, seed=None):
+        return self.transfrom(data, seed=seed)
 
-    def transfrom(self, data):
+    def get_affine(self, data, rng):
+        """
+        The affine transform (data @ M + b) of normalizing, centering, scaling and rotating data, and its random parameters.
+        """
+        M = np.eye(3)
+        if self.normalize is not None:
+            M = np.diag(1 / np.array(self.normalize, dtype=np.float64))
+        c = np.zeros(3)
+        if self.center:
+            # in float, the sum of int16 coordinates overflows
+            c = (np.amin(data, axis=0).astype(np.float64) + np.amax(data, axis=0)) / 2 @ M
+        scale = rng.uniform(0.9, 1.1) if self.random_scale else 1.0
+        R = np.eye(3)
+        angle = 0.0
+        if self.rotate_z:
+            angle = rng.uniform() * 2 * np.pi
+            R = rotation_z(angle)
+        angles = np.zeros(3)
+        if self.perturb_rotation:
+            angles = np.clip(0.06*rng.standard_normal(3), -0.18, 0.18)
+            R = R @ perturbation_rotation(angles)
+
+        M = M * scale @ R
+        b = -(c * scale) @ R
+        params = {'scale': scale, 'angle_z': angle,
+                  'perturb_angles': angles.tolist()}
+        return M, b, params
+
+    def transfrom(self, data, seed=None):
         """ Apply transforms to pointcloud data
         Input:
             NxD array
+            seed: of the random parameters, drawn from np.random if not given
         Output:
             NxD array
         """
@@ -39,20 +83,29 @@ class Augmentor(object):
             data = np.swapaxes(data, 0, 1)
             swapped = True
 
-        if self.num_points is not None:
-            data = sample_points(data, self.num_points)
+        # every random draw for this example comes from its seed
+        if seed is None:
+            seed = np.random.randint(2**31)
+        rng = np.random.default_rng(seed)
 
-        if self.normalize is not None:
-            data = normalize_point_cloud(data, self.normalize)
+        if self.num_points is not None and self.fps_order:
+            data = sample_fps_prefix(data, self.num_points, rng=rng)
+        elif self.num_points is not None:
+            data = sample_points(data, self.num_points, rng=rng)
 
-        if self.center:
-            data = center_pointcloud(data)
+        # one pass for the whole affine transform, integer coordinates become float32 here
+        (M, b, params) = self.get_affine(data, rng)
+        data = data @ M.astype(np.float32) + b.astype(np.float32)
 
-        if self.random_scale:
-            data = random_scale_point_cloud(data)
+        if self.jitter:
+            data += np.clip(0.01 * rng.standard_normal(data.shape),
+                            -0.05, 0.05).astype(np.float32)
 
-        if self.shuffle:
-            data = shuffle_points(data)
+        if self.shuffle and not self.fps_order:
+            data = data[rng.permutation(data.shape[0])]
+
+        params['seed'] = seed
+        self.last_params = params
 
         if swapped:
             data = np.swapaxes(data, 0, 1)
@@ -60,10 +113,192 @@ class Augmentor(object):
         return data
 
 
-def sample_points(data, num_points):
+class BatchAugmentor(torch.nn.Module):
+    def __init__(self,
+                 shuffle: bool = False,
+                 center: bool = False,
+                 random_scale: bool = False,
+                 num_points: int = None,
+                 normalize: tuple = [125, 1250, 1250],
+                 rotate_z: bool = False,
+                 perturb_rotation: bool = False,
+                 jitter: bool = False,
+                 on_device: bool = False,
+                 fps_order: bool = False,
+                 ):
+        """
+        Same transforms as Augmentor, done on a whole batch of pointclouds (BxCxN tensor) at once
+        with random parameters drawn for each cloud, the affine part is a single batched matmul.
+        Run at collate (see DatasetWithInfo.collate), or with on_device by the training loop once the batch is on the training device.
+        A batch can be reproduced with forward(x, seed=...), at collate the seed is derived from the seeds of its examples.
+        fps_order: points are stored in farthest point order, sampling takes the first num_points and nothing is shuffled.
+        """
+        super().__init__()
+        self.on_device = on_device
+        self.shuffle = shuffle
+        self.center = center
+        self.random_scale = random_scale
+        self.normalize = normalize
+        self.num_points = num_points
+        self.rotate_z = rotate_z
+        self.perturb_rotation = perturb_rotation
+        self.jitter = jitter
+        self.fps_order = fps_order
+        self.last_params = None
+
+    # tells DatasetWithInfo to augment batches rather than items
+    batched = True
+
+    def sample(self, x, generator=None):
+        # num_points of each cloud, with replacement if there are not enough
+        (b, c, n) = x.shape
+        if self.fps_order and n >= self.num_points:
+            # any prefix of a farthest point order is a farthest point sample
+            return x[:, :, :self.num_points]
+        elif self.fps_order:
+            # repeated points come after all others, so the order still holds
+            idx = torch.randint(
+                n, (b, self.num_points - n), device=x.device, generator=generator)
+            return torch.cat([x, torch.gather(x, 2, idx.unsqueeze(1).expand(-1, c, -1))], dim=2)
+        elif n >= self.num_points:
+            # a random subset without replacement, topk is much cheaper than a full sort
+            idx = torch.rand(b, n, device=x.device, generator=generator).topk(
+                self.num_points, dim=1, sorted=False).indices
+        else:
+            idx = torch.randint(
+                n, (b, self.num_points), device=x.device, generator=generator)
+        return torch.gather(x, 2, idx.unsqueeze(1).expand(-1, c, -1))
+
+    def stack(self, xs):
+        """
+        Stack a list of CxN clouds into a batch, clouds of different sizes (full clouds) are sampled to num_points first.
+        """
+        if len(set(x.shape[-1] for x in xs)) > 1:
+            assert self.num_points is not None, 'clouds differ in size, set num_points'
+            xs = [self.sample(x.unsqueeze(0))[0] for x in xs]
+        return torch.stack(xs)
+
+    def get_affine(self, x, generator):
+        """
+        The affine transform (M^T x + b) of each cloud in x and its random parameters, like Augmentor.get_affine.
+        """
+        (b, c, n) = x.shape
+        kw = {'device': x.device, 'generator': generator}
+        M = torch.eye(3, device=x.device).expand(b, 3, 3)
+        if self.normalize is not None:
+            M = torch.diag(1 / torch.tensor(self.normalize, dtype=torch.float32,
+                                            device=x.device)).expand(b, 3, 3)
+        center = torch.zeros((b, 1, 3), device=x.device)
+        if self.center:
+            # in float, the sum of int16 coordinates overflows
+            mid = (x.amin(dim=2).float() + x.amax(dim=2).float()) / 2
+            center = torch.bmm(mid.unsqueeze(1), M)
+        scale = torch.ones(b, device=x.device)
+        if self.random_scale:
+            scale = torch.rand(b, **kw) * 0.2 + 0.9
+        R = torch.eye(3, device=x.device).expand(b, 3, 3)
+        angle = torch.zeros(b, device=x.device)
+        if self.rotate_z:
+            angle = torch.rand(b, **kw) * 2 * np.pi
+            R = rotation_z(angle)
+        angles = torch.zeros((b, 3), device=x.device)
+        if self.perturb_rotation:
+            angles = torch.clamp(
+                0.06*torch.randn((b, 3), **kw), -0.18, 0.18)
+            R = torch.bmm(R, perturbation_rotation(angles))
+
+        M = torch.bmm(M * scale.view(b, 1, 1), R)
+        bias = -torch.bmm(center * scale.view(b, 1, 1), R)
+        params = {'scale': scale, 'angle_z': angle, 'perturb_angles': angles}
+        return M, bias, params
+
+    def forward(self, x, seed=None):
+        # every random draw for this batch comes from its seed
+        if seed is None:
+            seed = int(torch.randint(2**31, (1,)))
+        generator = torch.Generator(device=x.device)
+        generator.manual_seed(seed)
+
+        if self.num_points is not None:
+            x = self.sample(x, generator=generator)
+
+        # one batched matmul for the whole affine transform, integer coordinates become float here
+        (M, bias, params) = self.get_affine(x, generator)
+        x = torch.baddbmm(bias.transpose(1, 2),
+                          M.transpose(1, 2), x.float())
+
+        if self.jitter:
+            x = x + torch.clamp(0.01 * torch.randn(x.shape, device=x.device,
+                                                   generator=generator), -0.05, 0.05)
+
+        if self.shuffle and not self.fps_order:
+            # same shuffling idx for the entire batch, like shuffle_points
+            x = x[:, :, torch.randperm(
+                x.shape[2], device=x.device, generator=generator)]
+
+        params['seed'] = seed
+        self.last_params = params
+
+        return x
+
+
+def augment_seed(*keys):
+    """ Seed for Augmentor.transfrom or BatchAugmentor.forward derived from integer keys, e.g. (dataset seed, epoch, index),
+        so an augmented example is reproduced from its keys alone.
+    """
+    return int(np.random.SeedSequence([int(k) for k in keys]).generate_state(1)[0] >> 1)
+
+
+def rotation_z(angle):
+    """ Rotation (for row vectors) by angle about the up direction, as in rotate_point_cloud_z.
+        angle is a float, or a tensor of B angles for B matrices.
+    """
+    if torch.is_tensor(angle):
+        (cosval, sinval) = torch.cos(angle), torch.sin(angle)
+        (zero, one) = torch.zeros_like(angle), torch.ones_like(angle)
+        return torch.stack([torch.stack([cosval, sinval, zero], -1),
+                            torch.stack([-sinval, cosval, zero], -1),
+                            torch.stack([zero, zero, one], -1)], -2)
+    (cosval, sinval) = np.cos(angle), np.sin(angle)
+    return np.array([[cosval, sinval, 0],
+                     [-sinval, cosval, 0],
+                     [0, 0, 1]])
+
+
+def perturbation_rotation(angles):
+    """ Rotation (for row vectors) by small angles about each axis, as in rotate_perturbation_point_cloud.
+        angles is a 3 array, or a Bx3 tensor for B matrices.
+    """
+    if torch.is_tensor(angles):
+        (c, s) = torch.cos(angles), torch.sin(angles)
+        (zero, one) = torch.zeros_like(c[:, 0]), torch.ones_like(c[:, 0])
+
+        def mat(rows):
+            return torch.stack([torch.stack(r, -1) for r in rows], -2)
+        Rx = mat([[one, zero, zero], [zero, c[:, 0], -s[:, 0]],
+                  [zero, s[:, 0], c[:, 0]]])
+        Ry = mat([[c[:, 1], zero, s[:, 1]], [zero, one, zero],
+                  [-s[:, 1], zero, c[:, 1]]])
+        Rz = mat([[c[:, 2], -s[:, 2], zero], [s[:, 2], c[:, 2], zero],
+                  [zero, zero, one]])
+        return torch.bmm(Rz, torch.bmm(Ry, Rx))
+    Rx = np.array([[1, 0, 0],
+                   [0, np.cos(angles[0]), -np.sin(angles[0])],
+                   [0, np.sin(angles[0]), np.cos(angles[0])]])
+    Ry = np.array([[np.cos(angles[1]), 0, np.sin(angles[1])],
+                   [0, 1, 0],
+                   [-np.sin(angles[1]), 0, np.cos(angles[1])]])
+    Rz = np.array([[np.cos(angles[2]), -np.sin(angles[2]), 0],
+                   [np.sin(angles[2]), np.cos(angles[2]), 0],
+                   [0, 0, 1]])
+    return np.dot(Rz, np.dot(Ry, Rx))
+
+
+def sample_points(data, num_points, rng=None):
     """ Sample num_points from the point cloud
         Input:
             NxC array
+            rng: numpy Generator to sample with, np.random if not given
         Output:
             num_points x C array
     """
@@ -73,17 +308,36 @@ def sample_points(data, num_points):
         print(
             f'not enough points, need {num_points}, have {cur_points}, replace sampling to fix')
         replace = True
-    data = random_sample_arr(data, count=num_points, replace=replace)
+    data = random_sample_arr(data, count=num_points, replace=replace, rng=rng)
     return data
 
 
+def sample_fps_prefix(data, num_points, rng=None):
+    """ Sample num_points from a point cloud in farthest point order, the prefix is a farthest point sample.
+        Input:
+            NxC array
+            rng: numpy Generator to sample the repeats with, np.random if not given
+        Output:
+            num_points x C array
+    """
+    cur_points = data.shape[0]
+    if cur_points >= num_points:
+        return data[:num_points]
+    # repeated points come after all others, so the order still holds
+    extra = random_sample_arr(
+        data, count=num_points-cur_points, replace=True, rng=rng)
+    return np.concatenate([data, extra])
+
+
 def normalize_point_cloud(data, factor):
     """ Normalize data by factor amount in each dim
         Input:
             NxC array
         Output:
-            NxC array
+            NxC array, float32 if data is integer
     """
+    if not np.issubdtype(data.dtype, np.floating):
+        return np.divide(data, np.array(factor, dtype=np.float32), dtype=np.float32)
     data[:] /= np.array(factor)
     return data
 
@@ -1,12 +1,17 @@
 import cc3d
 import os
+import time
+import tracemalloc
+import json
+import shutil
+import hashlib
 import numpy as np
-from proofreader.utils.io import from_h5
-from proofreader.utils.data import zero_classes_with_zspan_less_than, zero_classes_with_min_volume, crop_where
+from proofreader.utils.io import read_volume, chunked_volume_path, CHUNKED_HEADER
+from proofreader.utils.data import LabelIndex, union_bbox, crop_where
 import h5py
 
 
-def read_cremi_volume(volname: str, img: bool = False, seg: bool = False, pad: bool = False, path: str = './dataset'):
+def read_cremi_volume(volname: str, img: bool = False, seg: bool = False, pad: bool = False, path: str = './dataset', lazy: bool = False):
 
     assert img or seg
 
@@ -16,26 +21,219 @@ def read_cremi_volume(volname: str, img: bool = False, seg: bool = False, pad: b
     full_path = os.path.join(path, f'{filename}.hdf')
 
     if img and seg:
-        i = from_h5(full_path, dataset_path='volumes/raw')
-        s = from_h5(full_path, dataset_path='volumes/labels/neuron_ids')
+        i = read_volume(full_path, dataset_path='volumes/raw', lazy=lazy)
+        s = read_volume(full_path, dataset_path='volumes/labels/neuron_ids', lazy=lazy)
         return (i, s)
     if img:
-        return from_h5(full_path, dataset_path='volumes/raw')
+        return read_volume(full_path, dataset_path='volumes/raw', lazy=lazy)
     if seg:
-        return from_h5(full_path, dataset_path='volumes/labels/neuron_ids')
+        return read_volume(full_path, dataset_path='volumes/labels/neuron_ids', lazy=lazy)
 
 
-def clean_cremi_vols(vols):
+def clean_cremi_vol(vol, min_zspan=3, min_volume=800, verbose=False):
+    """
+    Crop vol to its labels, zero labels on fewer than min_zspan+1 slices or with at most min_volume voxels,
+    then redo connected components. Same as crop_where, zero_classes_with_zspan_less_than
+    and zero_classes_with_min_volume in turn, but the labels are indexed in one pass and
+    the crop and both filters are a single lookup table remap into the output.
+    verbose: print the time and peak memory (traced with tracemalloc, which slows allocation) of each stage.
+    """
+    stages = []
+    tracing = tracemalloc.is_tracing()
+    if verbose and not tracing:
+        tracemalloc.start()
+
+    def end_stage(name, start):
+        peak = tracemalloc.get_traced_memory()[1] if verbose else 0
+        stages.append((name, time.time() - start, peak))
+        if verbose:
+            tracemalloc.reset_peak()
+
+    start = time.time()
+    index = LabelIndex(vol)
+    end_stage('index', start)
+
+    if len(index.labels) == 0:
+        # all background, nothing to crop to or keep
+        if verbose and not tracing:
+            tracemalloc.stop()
+        return np.zeros(vol.shape, dtype=vol.dtype)
+
+    start = time.time()
+    # remove any border, the bounding box of every label
+    crop = index.bboxes[0]
+    for bbox in index.bboxes[1:]:
+        crop = union_bbox(crop, bbox)
+    keep = index.labels[(index.nslices - 1 >= min_zspan)
+                        & (index.counts > min_volume)]
+
+    shape = tuple(s.stop - s.start for s in crop)
+    cleaned = np.empty(shape, dtype=vol.dtype)
+    max_label = int(index.labels[-1]) if len(index.labels) else 0
+    lut = None
+    if max_label < cleaned.size:
+        lut = np.zeros(max_label + 1, dtype=vol.dtype)
+        lut[keep] = keep
+    for z in range(shape[0]):
+        section = np.asarray(vol[(crop[0].start + z,) + crop[1:]])
+        if lut is not None:
+            cleaned[z] = lut[section]
+        else:
+            # labels too large for a table
+            cleaned[z] = np.where(np.isin(section, keep), section, 0)
+    end_stage('remap', start)
+
+    start = time.time()
+    cleaned = cc3d.connected_components(cleaned)
+    end_stage('cc3d', start)
+
+    if verbose:
+        if not tracing:
+            tracemalloc.stop()
+        report = ', '.join(f'{name} {t:.2f}s peak {peak / 2**20:.0f}MB'
+                           for name, t, peak in stages)
+        print(f'cleaned {vol.shape} -> {cleaned.shape}, kept {len(keep)}/{len(index.labels)} labels: {report}')
+
+    return cleaned
+
+
+def clean_cremi_vols(vols, min_zspan=3, min_volume=800, verbose=False):
     # we must clean the CREMI vols because they contain noise even in the GT segmentations
     for i in range(len(vols)):
-        vols[i] = crop_where(vols[i], vols[i] != 0)  # remove any border
-        vols[i] = zero_classes_with_zspan_less_than(vols[i], 3)
-        vols[i] = zero_classes_with_min_volume(vols[i], 800)
-        vols[i] = cc3d.connected_components(vols[i])
+        vols[i] = clean_cremi_vol(
+            vols[i], min_zspan=min_zspan, min_volume=min_volume, verbose=verbose)
     return vols
 
 
-def prepare_cremi_vols(path, validation_slices=None):
+# bump when the cleaning changes so old cached vols are not used
+CLEAN_VERSION = 1
+CLEAN_PARAMS = {'min_zspan': 3, 'min_volume': 800}
+
+
+def file_hash(file_name, cache_dir):
+    """
+    Hash of the contents of file_name, remembered in cache_dir for as long as its size and mtime do not change.
+    """
+    memo_path = os.path.join(cache_dir, 'hashes.json')
+    memo = {}
+    if os.path.exists(memo_path):
+        with open(memo_path) as f:
+            memo = json.load(f)
+
+    st = os.stat(file_name)
+    stamp = [st.st_size, st.st_mtime_ns]
+    key = os.path.abspath(file_name)
+    if key in memo and memo[key][:2] == stamp:
+        return memo[key][2]
+
+    h = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            h.update(block)
+    memo[key] = stamp + [h.hexdigest()]
+
+    tmp_path = f'{memo_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(memo, f)
+    os.replace(tmp_path, memo_path)
+    return h.hexdigest()
+
+
+def source_key(file_name, dataset_path, cache_dir):
+    """
+    Identifies what read_volume reads for dataset_path of file_name, its chunked copy when there is one.
+    A chunked copy is always rewritten as a whole, so the stamp of its header changes with any of its chunks.
+    """
+    header = os.path.join(chunked_volume_path(file_name, dataset_path), CHUNKED_HEADER)
+    if os.path.exists(header):
+        st = os.stat(header)
+        with open(header) as f:
+            return f'chunked {st.st_ino} {st.st_mtime_ns} {f.read()}'
+    return file_hash(file_name, cache_dir)
+
+
+def get_cleaned_vols_path(cache_dir, sources, params):
+    # key on the input (file, dataset path) sources and everything which changes the cleaned vols
+    h = hashlib.sha1()
+    for f, dataset_path in sources:
+        h.update(source_key(f, dataset_path, cache_dir).encode())
+    params = dict(params, clean_version=CLEAN_VERSION)
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return os.path.join(cache_dir, h.hexdigest()[:16])
+
+
+def load_cleaned_vols(cache_path):
+    """
+    Load cached splits of vols with memory mapping, or None if they are not cached.
+    The vols are copy on write, writable like freshly cleaned ones but writes never reach the cache.
+    """
+    splits_path = os.path.join(cache_path, 'splits.json')
+    if not os.path.exists(splits_path):
+        return None
+    with open(splits_path) as f:
+        lens = json.load(f)
+    return tuple([np.load(os.path.join(cache_path, f'{si}_{vi}.npy'), mmap_mode='c') for vi in range(n)]
+                 for si, n in enumerate(lens))
+
+
+def save_cleaned_vols(cache_path, splits):
+    # write somewhere private first so a half written cache is never loaded
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(tmp_path, exist_ok=True)
+        for si, vols in enumerate(splits):
+            for vi, vol in enumerate(vols):
+                np.save(os.path.join(tmp_path, f'{si}_{vi}.npy'), vol)
+        with open(os.path.join(tmp_path, 'splits.json'), 'w') as f:
+            json.dump([len(vols) for vols in splits], f)
+    except OSError as e:
+        # e.g. out of space, the vols are still returned uncached
+        print(f'could not cache cleaned vols in {cache_path}: {e}')
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        return splits
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # another run cached them first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return splits
+
+
+def get_cache_dir(path, cache_dir):
+    cache_dir = os.path.join(path, '.cleaned') if cache_dir is None else cache_dir
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def find_cleaned_vols(path, cache_dir, sources, params):
+    """
+    Where the cleaned splits of the (file, dataset path) sources are cached and the splits if they are, (None, None) when the cache
+    cannot be used (e.g. a read only dataset directory), the vols are then cleaned without it.
+    """
+    try:
+        cache_dir = get_cache_dir(path, cache_dir)
+        cache_path = get_cleaned_vols_path(cache_dir, sources, params)
+        return cache_path, load_cleaned_vols(cache_path)
+    except OSError as e:
+        print(f'not caching cleaned vols: {e}')
+        return None, None
+
+
+def prepare_cremi_vols(path, validation_slices=None, use_cache=True, cache_dir=None):
+    """
+    use_cache: keep the cleaned splits in cache_dir (defaults to path/.cleaned), keyed by the
+               hash of the input files (or their chunked copies) and the cleaning parameters, later calls memory map them (copy on write,
+               so they are writable either way).
+               Without a usable cache_dir the vols are cleaned as if use_cache were False.
+    """
+    cache_path = None
+    if use_cache:
+        sources = [(os.path.join(path, f'sample_{l}.hdf'), 'volumes/labels/neuron_ids') for l in 'ABC']
+        cache_path, splits = find_cleaned_vols(path, cache_dir, sources, dict(
+            CLEAN_PARAMS, prepare='cremi', validation_slices=validation_slices))
+        if splits is not None:
+            return splits
+
     trueA = read_cremi_volume('A', seg=True, path=path)
     trueB = read_cremi_volume('B', seg=True, path=path)
     trueC = read_cremi_volume('C', seg=True, path=path)
@@ -63,22 +261,39 @@ def prepare_cremi_vols(path, validation_slices=None):
                     trueC_train[vs:].copy()]
         train_vols = [trueA_train[:vs], trueB_train[:vs], trueC_train[:vs]]
         # redo connected_components to reconnect neurites
-        val_vols = clean_cremi_vols(val_vols)
+        val_vols = clean_cremi_vols(val_vols, **CLEAN_PARAMS)
     # redo connected_components to reconnect neurites
-    train_vols = clean_cremi_vols(train_vols)
-    test_vols = clean_cremi_vols(test_vols)
+    train_vols = clean_cremi_vols(train_vols, **CLEAN_PARAMS)
+    test_vols = clean_cremi_vols(test_vols, **CLEAN_PARAMS)
 
     if validation_slices is not None:
-        return train_vols, val_vols, test_vols
+        splits = (train_vols, val_vols, test_vols)
+    else:
+        splits = (train_vols, test_vols)
 
-    return train_vols, test_vols
+    if cache_path is not None:
+        save_cleaned_vols(cache_path, splits)
+    return splits
 
 
-def prepare_corrected_cremi_vols(path, validation_slices=None):
+def prepare_corrected_cremi_vols(path, validation_slices=None, use_cache=True, cache_dir=None):
+    """
+    use_cache: keep the cleaned splits in cache_dir (defaults to path/.cleaned), keyed by the
+               hash of the input files (or their chunked copies) and the cleaning parameters, later calls memory map them (copy on write,
+               so they are writable either way).
+               Without a usable cache_dir the vols are cleaned as if use_cache were False.
+    """
+    cache_path = None
+    if use_cache:
+        sources = [(os.path.join(path, f'seg_{l}.h5'), '/main') for l in 'ABC']
+        cache_path, splits = find_cleaned_vols(path, cache_dir, sources, dict(
+            CLEAN_PARAMS, prepare='corrected', validation_slices=validation_slices))
+        if splits is not None:
+            return splits
 
-    A = from_h5(f'{path}/seg_A.h5')
-    B = from_h5(f'{path}/seg_B.h5')
-    C = from_h5(f'{path}/seg_C.h5')
+    A = read_volume(f'{path}/seg_A.h5')
+    B = read_volume(f'{path}/seg_B.h5')
+    C = read_volume(f'{path}/seg_C.h5')
 
     # remove any border
     A = crop_where(A, A != 0)
@@ -103,15 +318,19 @@ def prepare_corrected_cremi_vols(path, validation_slices=None):
         train_vols = [A_train[:vs].copy(), B_train[:vs].copy(),
                       C_train[:vs].copy()]
         # redo connected_components to reconnect neurites
-        val_vols = clean_cremi_vols(val_vols)
+        val_vols = clean_cremi_vols(val_vols, **CLEAN_PARAMS)
     # redo connected_components to reconnect neurites
-    train_vols = clean_cremi_vols(train_vols)
-    test_vols = clean_cremi_vols(test_vols)
+    train_vols = clean_cremi_vols(train_vols, **CLEAN_PARAMS)
+    test_vols = clean_cremi_vols(test_vols, **CLEAN_PARAMS)
 
     if validation_slices is not None:
-        return train_vols, val_vols, test_vols
+        splits = (train_vols, val_vols, test_vols)
+    else:
+        splits = (train_vols, test_vols)
 
-    return train_vols, test_vols
+    if cache_path is not None:
+        save_cleaned_vols(cache_path, splits)
+    return splits
 
 
 if __name__ == '__main__':
@@ -0,0 +1,422 @@
+import os
+import json
+import uuid
+import numpy as np
+import torch
+
+
+MANIFEST = 'manifest.json'
+SUMMARY = 'summary.npz'
+
+# merge information as written to disk, one record per example
+INFO_DTYPE = np.dtype([('top_class', 'i8'), ('bot_class', 'i8'), ('drop_start', 'i8'),
+                       ('drop_end', 'i8'), ('volume_i', 'i8'), ('label', '?')])
+# merge information carried with the examples once loaded, bid is the canidate group of each
+MERGE_INFO_DTYPE = np.dtype(INFO_DTYPE.descr + [('bid', 'i8')])
+
+
+def read_manifest(path):
+    manifest_path = os.path.join(path, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return {'shards': []}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def write_manifest(path, manifest):
+    # write then rename so a crash never leaves a partial manifest
+    manifest_path = os.path.join(path, MANIFEST)
+    tmp_path = f'{manifest_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def get_completed_units(manifest):
+    return set(tuple(u) for shard in manifest['shards'] for u in shard['units'])
+
+
+def shard_file(path, name, part):
+    return os.path.join(path, f'{name}_{part}.npy')
+
+
+def remove_incomplete_shards(path, manifest):
+    """
+    Remove shard files which never made it into the manifest, left over from a crashed run.
+    """
+    names = set(shard['name'] for shard in manifest['shards'])
+    for f in os.listdir(path):
+        if f.startswith('shard_') and f.endswith('.npy') and f.rsplit('_', 1)[0] not in names:
+            os.remove(os.path.join(path, f))
+
+
+def compact_coordinates(x):
+    """
+    Clouds of integer voxel coordinates, which are relative to each example's min corner,
+    are stored as int16 and converted to float when normalized at load time. Anything else is kept as is.
+    """
+    info = np.iinfo(np.int16)
+    if x.size == 0 or (np.issubdtype(x.dtype, np.floating) and np.all(np.floor(x) == x)
+                       and x.min() >= info.min and x.max() <= info.max):
+        return x.astype(np.int16)
+    return x
+
+
+def infos_to_records(infos, bid=None):
+    """
+    Columnar merge information from info records or dicts (as in the old single file datasets).
+    With bid (the canidate group of each, or one for all) the records are MERGE_INFO_DTYPE.
+    """
+    records = np.zeros(len(infos), dtype=INFO_DTYPE if bid is None else MERGE_INFO_DTYPE)
+    for k in INFO_DTYPE.names:
+        records[k] = infos[k] if isinstance(
+            infos, np.ndarray) else [info[k] for info in infos]
+    if bid is not None:
+        records['bid'] = bid
+    return records
+
+
+class ShardWriter(object):
+    """
+    Buffers canidate groups and writes them to path as shards once they hold at least shard_size groups.
+    Shards are only closed between (volume, drop) units so a unit is always entirely in one shard.
+    meta: extra fields for every shard record, e.g. how the clouds were ordered.
+    """
+
+    def __init__(self, path, shard_size, prefix, meta=None):
+        self.path = path
+        self.shard_size = shard_size
+        self.prefix = prefix
+        self.meta = {} if meta is None else meta
+        self.shard_i = 0
+        self.reset()
+
+    def reset(self):
+        self.xs, self.ys, self.infos = [], [], []
+        self.units = []
+
+    def add(self, x, y, info):
+        self.xs.append(x)
+        self.ys.append(y)
+        self.infos.append(info)
+
+    def end_unit(self, unit):
+        self.units.append([int(u) for u in unit])
+
+    def full(self):
+        return len(self.xs) >= self.shard_size
+
+    def flush(self):
+        if len(self.xs) == 0:
+            self.reset()
+            return None
+
+        name = f'shard_{self.prefix}_{self.shard_i:05d}'
+        offsets = np.cumsum([0] + [len(y) for y in self.ys])
+        ragged = isinstance(self.xs[0], list)
+        if ragged:
+            # full clouds of any size, their points (N x C) one after another and where each cloud starts
+            clouds = [c.numpy().T for x in self.xs for c in x]
+            points = np.cumsum([0] + [len(c) for c in clouds])
+            np.save(shard_file(self.path, name, 'x'), compact_coordinates(np.concatenate(
+                clouds) if clouds else np.zeros((0, 3), dtype='float32')))
+            np.save(shard_file(self.path, name, 'points'), points)
+        else:
+            np.save(shard_file(self.path, name, 'x'),
+                    compact_coordinates(torch.cat(self.xs).numpy()))
+        np.save(shard_file(self.path, name, 'y'),
+                torch.cat(self.ys).numpy().astype('int64'))
+        np.save(shard_file(self.path, name, 'info'),
+                infos_to_records(np.concatenate(self.infos)))
+        np.save(shard_file(self.path, name, 'offsets'), offsets)
+
+        shard = {'name': name, 'groups': len(self.xs),
+                 'examples': int(offsets[-1]), 'units': self.units, 'ragged': ragged, **self.meta}
+        self.shard_i += 1
+        self.reset()
+        return shard
+
+
+class ShardWriterDataset(torch.utils.data.IterableDataset):
+    """
+    Runs a candidate group dataset inside each worker and writes its groups straight to shards,
+    only the shard records are passed back to the main process.
+    paths: output directory for each gap size (num_slices) the dataset generates.
+    """
+
+    def __init__(self, dataset, paths, shard_size):
+        self.dataset = dataset
+        self.paths = paths
+        self.shard_size = shard_size
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        # unique per run so resumed runs never overwrite earlier shards
+        prefix = f'{uuid.uuid4().hex[:8]}_{worker_id}'
+        writers = {ns: ShardWriter(path, self.shard_size, prefix, meta=get_fps_meta(self.dataset))
+                   for ns, path in self.paths.items()}
+
+        unit = None
+        for x, y, info in self.dataset:
+            cur_unit = (self.dataset.cur_vol_i, self.dataset.cur_drop_start,
+                        self.dataset.num_slices)
+            if unit is not None and cur_unit != unit:
+                writer = writers[unit[2]]
+                writer.end_unit(unit[:2])
+                if writer.full():
+                    yield unit[2], writer.flush()
+            unit = cur_unit
+            writers[unit[2]].add(x, y, info)
+
+        if unit is not None:
+            writers[unit[2]].end_unit(unit[:2])
+        for ns, writer in writers.items():
+            shard = writer.flush()
+            if shard is not None:
+                yield ns, shard
+
+
+def get_fps_meta(dataset):
+    # the clouds of a dataset with fps_points start in farthest point order
+    fps_points = getattr(dataset, 'fps_points', None)
+    if not fps_points:
+        return {}
+    return {'fps_points': int(fps_points), 'fps_normalize': [float(f) for f in dataset.fps_normalize]}
+
+
+def read_fps_order(path):
+    """
+    How many points of every cloud under path are stored in farthest point order (0 if any shard has none),
+    and the normalize factor the order was measured with.
+    """
+    shards = read_manifest(path)['shards']
+    if len(shards) == 0 or any(not shard.get('fps_points', 0) for shard in shards):
+        return 0, None
+    normalize = set(tuple(shard['fps_normalize']) for shard in shards)
+    assert len(normalize) == 1, 'shards were ordered with different normalize factors'
+    return min(shard['fps_points'] for shard in shards), normalize.pop()
+
+
+def write_shards(dataset, paths, shard_size=1000, num_workers=0, resume=True, params=None):
+    """
+    Stream the canidate groups of dataset into shards, tracked by a manifest in each output directory.
+    paths: output directory for each gap size (num_slices) of dataset.
+    With resume, (volume, drop) units already in a manifest are skipped.
+    params: the generation parameters, kept in the manifest, shards are only resumed when they were generated with the same ones.
+    """
+    manifests = {}
+    skip_units = set()
+    for ns, path in paths.items():
+        if not os.path.exists(path):
+            os.makedirs(path)
+        manifest = read_manifest(path) if resume else {'shards': []}
+        if params is not None:
+            # json has no tuples, compare as they are read back
+            params = json.loads(json.dumps(params))
+            assert len(manifest['shards']) == 0 or manifest.get('params') == params, \
+                f'{path} has shards generated with {manifest.get("params")}, not {params}, use --no-resume or another output dir'
+            manifest['params'] = params
+        remove_incomplete_shards(path, manifest)
+        write_manifest(path, manifest)
+        manifests[ns] = manifest
+        skip_units |= set(u + (ns,) for u in get_completed_units(manifest))
+    dataset.skip_units = skip_units
+
+    def collate_fn(data):
+        assert len(data) == 1, 'only supports batch_size of 1'
+        return data[0]
+
+    iterator = torch.utils.data.DataLoader(dataset=ShardWriterDataset(dataset, paths, shard_size),
+                                           batch_size=1, num_workers=num_workers, collate_fn=collate_fn)
+    for ns, shard in iterator:
+        manifests[ns]['shards'].append(shard)
+        write_manifest(paths[ns], manifests[ns])
+        print(
+            f'wrote {shard["name"]} to {paths[ns]}, groups: {shard["groups"]}, examples: {shard["examples"]}')
+
+    return manifests
+
+
+def load_shards(path):
+    """
+    Read every shard under path into lists of canidate groups, same as the old single file datasets.
+    y is (label, bid) where bid is the index of the group across all shards, info is MERGE_INFO_DTYPE records.
+    """
+    manifest = read_manifest(path)
+    all_x, all_y, all_i = [], [], []
+    for shard in manifest['shards']:
+        name = shard['name']
+        x = torch.from_numpy(np.load(shard_file(path, name, 'x')))
+        y = torch.from_numpy(np.load(shard_file(path, name, 'y')))
+        info = np.load(shard_file(path, name, 'info'))
+        offsets = np.load(shard_file(path, name, 'offsets'))
+        if shard.get('ragged', False):
+            # a list of C x N clouds for each group
+            points = np.load(shard_file(path, name, 'points'))
+            x = [x[a:b].T for a, b in zip(points[:-1], points[1:])]
+        for s, e in zip(offsets[:-1], offsets[1:]):
+            bid = torch.zeros_like(y[s:e]) + len(all_y)
+            all_x.append(x[s:e])
+            all_i.append(infos_to_records(info[s:e], bid=len(all_y)))
+            all_y.append(torch.stack((y[s:e], bid), dim=1))
+
+    return all_x, all_y, all_i
+
+
+class ShardArray(object):
+    """
+    Rows of one array spread over several shard files, opened with memory mapping on first access.
+    Only the file paths are pickled so DataLoader workers never copy the data.
+    """
+
+    def __init__(self, files):
+        self.files = files
+        self.arrays = None
+        self.starts = None
+
+    def open(self):
+        self.arrays = [np.load(f, mmap_mode='r') for f in self.files]
+        self.starts = np.cumsum([0] + [len(a) for a in self.arrays])
+
+    def __getstate__(self):
+        return {'files': self.files, 'arrays': None, 'starts': None}
+
+    def __len__(self):
+        if self.arrays is None:
+            self.open()
+        return int(self.starts[-1])
+
+    def __getitem__(self, i):
+        if self.arrays is None:
+            self.open()
+        if isinstance(i, slice):
+            i = np.arange(*i.indices(len(self)))
+        if np.ndim(i) == 0:
+            s = np.searchsorted(self.starts, i, side='right') - 1
+            return self.arrays[s][i - self.starts[s]]
+
+        # gather rows from each shard they fall in
+        i = np.asarray(i)
+        shard_of = np.searchsorted(self.starts, i, side='right') - 1
+        out = np.empty((len(i),) + self.arrays[0].shape[1:],
+                       dtype=np.result_type(*self.arrays))
+        for s in np.unique(shard_of):
+            m = shard_of == s
+            out[m] = self.arrays[s][i[m] - self.starts[s]]
+        return out
+
+
+class RaggedArray(object):
+    """
+    Clouds of differing sizes, stored as their points (N x C) one after another and the offsets of each cloud into them.
+    Indexing gives a C x N cloud like the fixed size datasets, sample it down to a fixed number of points after.
+    """
+
+    def __init__(self, points, offsets):
+        self.points = points
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return np.asarray(self.points[self.offsets[i]:self.offsets[i+1]]).T
+
+
+def summary_path(path):
+    # inside sharded datasets, next to single file ones
+    if os.path.isdir(path):
+        return os.path.join(path, SUMMARY)
+    return f'{os.path.splitext(path)[0]}_{SUMMARY}'
+
+
+def dataset_stamp(path):
+    # changes whenever the dataset is rewritten
+    st = os.stat(os.path.join(path, MANIFEST) if os.path.isdir(path) else path)
+    return np.array([st.st_size, st.st_mtime_ns])
+
+
+def read_summary(path):
+    """
+    The labels of every example and the offsets of each canidate group into them, from the sidecar of the dataset at path.
+    None if there is no sidecar or the dataset changed since it was written.
+    """
+    sidecar = summary_path(path)
+    if not os.path.exists(sidecar):
+        return None
+    with np.load(sidecar) as f:
+        if not np.array_equal(f['stamp'], dataset_stamp(path)):
+            return None
+        return f['labels'].astype('int64'), f['offsets']
+
+
+def write_summary(path, labels, offsets):
+    sidecar = summary_path(path)
+    tmp_path = f'{sidecar}.{os.getpid()}.tmp.npz'
+    try:
+        np.savez(tmp_path, labels=labels.astype('int8'),
+                 offsets=offsets, stamp=dataset_stamp(path))
+        os.replace(tmp_path, sidecar)
+    except OSError:
+        # e.g. a read only dataset, the summary is just built again next time
+        pass
+
+
+def open_shards(path):
+    """
+    Open the shards under path without reading the examples.
+    Returns x (a ShardArray, or RaggedArray for full clouds) and info as ShardArray, all labels,
+    and the offsets of each canidate group into them.
+    """
+    manifest = read_manifest(path)
+    names = [shard['name'] for shard in manifest['shards']]
+    x = ShardArray([shard_file(path, n, 'x') for n in names])
+    info = ShardArray([shard_file(path, n, 'info') for n in names])
+
+    ragged = [shard.get('ragged', False) for shard in manifest['shards']]
+    assert len(set(ragged)) <= 1, 'cannot mix full clouds and fixed size clouds'
+    if any(ragged):
+        points = [np.zeros(1, dtype='int64')]
+        for n in names:
+            points.append(np.load(shard_file(path, n, 'points'))[1:] + points[-1][-1])
+        x = RaggedArray(x, np.concatenate(points))
+
+    summary = read_summary(path)
+    if summary is None:
+        labels, offsets = [np.zeros(0, dtype='int64')], [np.zeros(1, dtype='int64')]
+        for n in names:
+            labels.append(np.load(shard_file(path, n, 'y')))
+            offsets.append(np.load(shard_file(path, n, 'offsets'))[1:] + offsets[-1][-1])
+        summary = (np.concatenate(labels), np.concatenate(offsets))
+        write_summary(path, *summary)
+    (labels, offsets) = summary
+
+    return x, labels, info, offsets
+
+
+def get_truncated_index(offsets, truncate_canidates):
+    """
+    Rows kept when each canidate group is cut to its first truncate_canidates examples,
+    and the group (bid) of each kept row. 0 keeps everything, negative drops from the end like a slice.
+    """
+    lengths = np.diff(offsets)
+    if truncate_canidates == 0:
+        kept = lengths
+    elif truncate_canidates < 0:
+        kept = np.clip(lengths + truncate_canidates, 0, None)
+    else:
+        kept = np.minimum(lengths, truncate_canidates)
+
+    bid = np.repeat(np.arange(len(kept)), kept)
+    group_starts = np.cumsum(kept) - kept
+    index = offsets[:-1][bid] + np.arange(len(bid)) - group_starts[bid]
+    return index, bid, kept
+
+
+def dataset_split_path(path, split):
+    # sharded directories take precedence over the single file format
+    shard_path = f'{path}_{split}'
+    if os.path.isdir(shard_path):
+        return shard_path
+    return f'{path}_{split}.pt'
@@ -3,10 +3,13 @@ from proofreader.data.cremi import prepare_cremi_vols, prepare_corrected_cremi_v
 import click
 import torch.multiprocessing
 from proofreader.data.augment import Augmentor
-from typing import List
+from proofreader.data.shards import write_shards, INFO_DTYPE
+from proofreader.utils.io import share_volumes
+from typing import List, Union
 import numpy as np
 import torch
 import random
+import itertools
 import cc3d
 from proofreader.utils.vis import *
 from proofreader.utils.data import *
@@ -44,6 +47,7 @@ class NeuriteDataset(torch.utils.data.Dataset):
                  swapaxes: bool = True,
                  torch: bool = True,
                  Augmentor: Augmentor = Augmentor(),
+                 share_vols: bool = False,
                  ):
         """
         Parameters:
@@ -62,6 +66,7 @@ class NeuriteDataset(torch.utils.data.Dataset):
             swapaxes (bool): whether to swap axes (0,1). True -> CxN, False -> NxC.
             torch (bool): whether to convert to torch tensors.
             Augmentor (PCAugmentor or None): object to peform point cloud data augmentation.
+            share_vols (bool): place vols in shared memory, which workers attach to read only instead of each getting a copy.
         """
 
         super().__init__()
@@ -72,9 +77,11 @@ class NeuriteDataset(torch.utils.data.Dataset):
             assert len(
                 num_slices) == 2, 'if num_slices is list must be len == 2 in indicating range.'
 
-        self.vols = vols
+        self.vols = share_volumes(vols) if share_vols else vols
         self.classes = []  # all possible neurite classes
         self.class_i_to_vol_i = []  # maps a neurite class index to vol index
+        # where each class lives in each vol
+        self.label_indices = [get_label_index(vol) for vol in vols]
         self.num_slices = num_slices
         self.radius = radius
         self.context_slices = context_slices
@@ -114,7 +121,7 @@ class NeuriteDataset(torch.utils.data.Dataset):
         self.true_length = length*2
         self.effective_length = self.true_length * self.epoch_multplier
 
-    def get_volumetric_example(self, vol, c, label, num_slices, radius, context_slices):
+    def get_volumetric_example(self, vol, c, label, num_slices, radius, context_slices, index):
         """
         Gets a postive or negative example from vol using some class seed. Returns the volmertic representation of example.
             c (int): label of a neurite in vol to use as source
@@ -122,20 +129,15 @@ class NeuriteDataset(torch.utils.data.Dataset):
             radius (int): radius (voxels) on bottom cross section in which to select second neurite
             num_slices (int): number of slices to drop
             context_slices (int): max number of slice on top and bottom neurites
+            index (LabelIndex): where each class lives in vol
         """
         margin = 1  # number of slices that must be left on top after droping slices
         top_c = c
         (sz, sy, sx) = vol.shape
 
         # Find min and max z slice on which c occurs #
-        for i in range(sz):
-            if c in vol[i]:
-                zmin = i
-                break
-        for i in reversed(range(sz)):
-            if c in vol[i]:
-                zmax = i
-                break
+        (zmin, zmax) = index.zrange(top_c)
+        (_, top_y, top_x) = index.bbox(top_c)
         assert zmax - zmin >= num_slices + \
             2, f'zspan of neurite must be at least 2 slices bigger than num_slices to drop, zspan:{zmax - zmin}, num_slices:{num_slices}'
 
@@ -153,13 +155,11 @@ class NeuriteDataset(torch.utils.data.Dataset):
             print(
                 f'num_slices: {num_slices}, drop: [{drop_start}, {drop_end}]')
 
-        # Alloc final vol, we dont know how large it will be in y and x but we know max z #
-        mz = num_slices + top_z_len + bot_z_len
-        final_vol = np.zeros((mz, sy, sx), dtype='uint')
-
-        # Build top section #
-        top_vol_section = final_vol[0:top_z_len]
-        top_vol_section[vol[drop_start-top_z_len:drop_start] == top_c] = top_c
+        # Build top section, only inside the bounding box of the top class #
+        top_vol_section = np.zeros(
+            (top_z_len, top_y.stop-top_y.start, top_x.stop-top_x.start), dtype='uint')
+        top_vol_section[vol[drop_start-top_z_len:drop_start,
+                            top_y, top_x] == top_c] = top_c
 
         # Do connected component relabeling to ensure only one fragment on top #
         top_vol_section_relabeled = cc3d.connected_components(top_vol_section)
@@ -175,12 +175,15 @@ class NeuriteDataset(torch.utils.data.Dataset):
         top_border = top_vol_section_relabeled[-1]
         # use the relabeled top section
         (com_x, com_y) = ndimage.measurements.center_of_mass(top_border)
-        (com_x, com_y) = round(com_x), round(com_y)
+        # in vol coordinates
+        (com_x, com_y) = round(com_x + top_y.start), round(com_y + top_x.start)
 
         # Find all neurites with distnce D from that point on bottom cross section #
-        bot_border = vol[drop_end].copy()  # need copy because we zero
+        # bottom neurites can only be within radius of the top neurite #
+        (win_y, win_x) = grow_bbox((top_y, top_x), radius, (sy, sx))
+        bot_border = vol[drop_end, win_y, win_x].copy()  # need copy because we zero
         mask = circular_mask(
-            bot_border.shape[0], bot_border.shape[1], center=(com_y, com_x), radius=radius)
+            bot_border.shape[0], bot_border.shape[1], center=(com_y-win_x.start, com_x-win_y.start), radius=radius)
         bot_border[~mask] = 0
         mismatch_classes = list(np.unique(bot_border))
 
@@ -201,9 +204,12 @@ class NeuriteDataset(torch.utils.data.Dataset):
             # select bottom neurite class
             bot_c = random.choice(mismatch_classes)
 
-        # Build bot section #
-        bot_vol_section = final_vol[num_slices+top_z_len:]
-        bot_vol_section[vol[drop_end:drop_end+bot_z_len] == bot_c] = bot_c
+        # Build bot section, only inside the bounding box of the bottom class #
+        (_, bot_y, bot_x) = index.bbox(bot_c)
+        bot_vol_section = np.zeros(
+            (bot_z_len, bot_y.stop-bot_y.start, bot_x.stop-bot_x.start), dtype='uint')
+        bot_vol_section[vol[drop_end:drop_end+bot_z_len,
+                            bot_y, bot_x] == bot_c] = bot_c
 
         # Do connected component relabeling to ensure only one fragment on bottom #
         # The mask and radius are needed for both positive and negative examples #
@@ -211,8 +217,10 @@ class NeuriteDataset(torch.utils.data.Dataset):
         bot_vol_section_relabeled = cc3d.connected_components(bot_vol_section)
 
         bot_border_relabled = bot_vol_section_relabeled[0]
+        bot_mask = circular_mask(
+            bot_border_relabled.shape[0], bot_border_relabled.shape[1], center=(com_y-bot_x.start, com_x-bot_y.start), radius=radius)
         relabeled_fragments_in_radius = list(
-            np.unique(bot_border_relabled[mask]))
+            np.unique(bot_border_relabled[bot_mask]))
         relabeled_fragments_in_radius = list_remove(
             relabeled_fragments_in_radius, 0)
         if len(relabeled_fragments_in_radius) == 0:
@@ -225,9 +233,18 @@ class NeuriteDataset(torch.utils.data.Dataset):
         bot_vol_section_relabeled[bot_vol_section_relabeled !=
                                   relabeled_bot_c] = 0
 
+        # Alloc final vol just large enough in y and x for both sections #
+        mz = num_slices + top_z_len + bot_z_len
+        (ex_y, ex_x) = union_bbox((top_y, top_x), (bot_y, bot_x))
+        final_vol = np.zeros(
+            (mz, ex_y.stop-ex_y.start, ex_x.stop-ex_x.start), dtype='uint')
+
         # Build final volume of top and bottom sections #
-        final_vol[0: top_z_len] = top_vol_section_relabeled
-        final_vol[num_slices+top_z_len:] = bot_vol_section_relabeled
+        origin = (ex_y.start, ex_x.start)
+        (ty, tx) = shift_bbox((top_y, top_x), origin)
+        (by, bx) = shift_bbox((bot_y, bot_x), origin)
+        final_vol[0: top_z_len, ty, tx] = top_vol_section_relabeled
+        final_vol[num_slices+top_z_len:, by, bx] = bot_vol_section_relabeled
 
         return final_vol
 
@@ -239,11 +256,12 @@ class NeuriteDataset(torch.utils.data.Dataset):
         c = self.classes[index]
         vol_i = self.class_i_to_vol_i[index]
         vol = self.vols[vol_i]
+        index = self.label_indices[vol_i]
 
         if self.verbose:
             print(f'{label}, vol: {vol_i}, c: {c}')
 
-        return vol, c, label
+        return vol, c, label, index
 
     def convert_to_point_cloud(self, vol):
 
@@ -281,12 +299,13 @@ class NeuriteDataset(torch.utils.data.Dataset):
 
     def get_example(self, index):
 
-        vol, c, label = self.get_vol_class_label_from_index(index)
+        vol, c, label, label_index = self.get_vol_class_label_from_index(
+            index)
 
         # choose num_slices
         num_slices = random.randint(self.num_slices[0], self.num_slices[1])
         vol_example = self.get_volumetric_example(
-            vol, c, label, num_slices, self.radius, self.context_slices)
+            vol, c, label, num_slices, self.radius, self.context_slices, label_index)
 
         # if we cant build example, try again with random index
         if self.retry and vol_example is None:
@@ -340,7 +359,7 @@ class NeuriteDataset(torch.utils.data.Dataset):
 class SliceDataset(torch.utils.data.IterableDataset):
     def __init__(self,
                  vols: List,
-                 num_slices: int,
+                 num_slices: Union[int, List[int]],
                  radius: int,
                  context_slices: int,
                  num_points: int = None,
@@ -350,10 +369,25 @@ class SliceDataset(torch.utils.data.IterableDataset):
                  scale: int = None,
                  Augmentor: Augmentor = Augmentor(),
                  verbose: bool = False,
+                 skip_units: set = None,
+                 share_vols: bool = False,
+                 fps_points: int = None,
+                 fps_normalize: tuple = (125, 1250, 1250),
+                 drops_per_unit: int = 4,
                  ):
+        """
+        fps_points: put the first fps_points points of every cloud in farthest point order (measured after dividing by fps_normalize,
+                    the normalize factor used at load time), any prefix of them is then a farthest point sample for the models.
+        drops_per_unit: consecutive drops handed to a worker at once, with all of their gap sizes,
+                        so the worker reuses the slice components they share.
+        """
 
-        self.vols = vols
-        self.num_slices = num_slices
+        # in shared memory, workers attach to them read only instead of each getting a copy
+        self.vols = share_volumes(vols) if share_vols else vols
+        # several gap sizes share the per drop setup, they are visited together
+        self.all_num_slices = [num_slices] if isinstance(
+            num_slices, int) else list(num_slices)
+        self.num_slices = self.all_num_slices[0]
         self.radius = radius
         self.context_slices = context_slices
         self.num_points = num_points
@@ -363,6 +397,11 @@ class SliceDataset(torch.utils.data.IterableDataset):
         self.candidate_group = candidate_group
         self.allow_multiple = allow_multiple
         self.scale = scale
+        self.fps_points = fps_points
+        self.fps_normalize = fps_normalize
+        self.drops_per_unit = drops_per_unit
+        # (volume_i, drop_start, num_slices) to pass over, e.g. already written when resuming
+        self.skip_units = set() if skip_units is None else skip_units
 
         self.test_iteration_batch = None
         self.test_iteration_i = 0
@@ -371,64 +410,65 @@ class SliceDataset(torch.utils.data.IterableDataset):
         self.top_neurites = np.zeros((0))
         self.cur_neurite_i = 0
         self.vol_relabeled = None
+        self.slab_start = 0
+        self.slice_components = {}
+        self.label_index = None
         self.label_map = None
 
         self.cur_drop_start = context_slices-1
         self.cur_vol_i = 0
         self.worker_id = 0
 
+        # units, runs of (volume_i, drop_start, num_slices), are handed out to workers through a shared counter,
+        # [pass id, next unit, workers started, workers finished, workers in the pass], see begin_pass and steal_units
+        self.units = None
+        self.unit_counter = torch.multiprocessing.Array('q', 5)
+
     def load_next_candidate_batch(self):
 
-        if self.cur_neurite_i >= self.top_neurites.shape[0]:
+        # a drop can have no top neurites, then just move on to the next
+        while self.cur_neurite_i >= self.top_neurites.shape[0]:
             if self.verbose:
                 print('getting all top neurites for drop')
 
-            # only increment if its not the init
-            if self.top_neurites.shape[0] > 0:
-                self.increment_vol_and_drop()
+            self.next_unit()
 
             vol = self.get_cur_vol()
             (drop_start, drop_end) = self.get_cur_drop()
 
             cs = self.context_slices
 
-            # build a new vol with slices dropped in the middle
-            # and do connected_components do relablel/detach neurites on
-            # either side of the volume
-            vol_relabeled = np.zeros_like(vol)
+            # relabel/detach neurites on either side of the dropped slices with connected components,
+            # only the slab of context slices around the drop is ever read so only it is built,
+            # with multiple the components still span the whole of either side
             if self.allow_multiple:
-                vol_relabeled[:drop_start] = vol[:drop_start]
-                vol_relabeled[drop_end:] = vol[drop_end:]
+                zranges = [(0, drop_start), (drop_end, vol.shape[0])]
             else:
-                vol_relabeled[drop_start -
-                              cs:drop_start] = vol[drop_start-cs:drop_start]
-                vol_relabeled[drop_end:drop_end+cs] = vol[drop_end:drop_end+cs]
-            # vol_relabeled[:drop_start] = vol[:drop_start]
-            # vol_relabeled[drop_end:] = vol[drop_end:]
-
-            # remeber where the background is then reset in after cc
-            zero_indices = vol_relabeled == 0
-            vol_relabeled = cc3d.connected_components(vol_relabeled)
-            vol_relabeled[zero_indices] = 0
-
-            # # if we allowed multiple then recrop afterwards
-            # if self.allow_multiple:
-            #     vol_relabeled[drop_start -cs:drop_start]
-
-            # create a map from the new lables to the original labels
+                zranges = [(drop_start-cs, drop_start), (drop_end, drop_end+cs)]
+            slab_start = drop_start - cs
+            if self.cur_vol_i not in self.slice_components:
+                self.slice_components[self.cur_vol_i] = SliceComponents(
+                    vol, cache_size=2*cs+2)
+            vol_relabeled, zmins, label_map = self.slice_components[self.cur_vol_i].relabel(
+                zranges, (slab_start, drop_end+cs))
+            # where each neurite lives so examples are built without full slice copies
+            label_index = LabelIndex(vol_relabeled, zmins=zmins-slab_start)
+            # label_map maps the new lables to the original labels
             # this allows us to figure out the ground truth for accuracy
-            label_map = correspond_labels(vol_relabeled, vol, bg_label=0)
 
             # take the neurites on the top border of the missing slices
-            top_neurites = np.unique(vol_relabeled[drop_start-1])
+            top_neurites = np.unique(vol_relabeled[cs-1])
             top_neurites = np.delete(top_neurites, 0)
             np.random.shuffle(top_neurites)
             self.top_neurites = top_neurites
             self.cur_neurite_i = 0
             self.vol_relabeled = vol_relabeled
+            self.slab_start = slab_start
+            self.label_index = label_index
             self.label_map = label_map
 
-        drop = self.get_cur_drop()
+        # drop within the relabeled slab
+        drop = tuple(d - self.slab_start for d in self.get_cur_drop())
         c = self.top_neurites[self.cur_neurite_i]
 
         if self.verbose:
@@ -436,7 +476,7 @@ class SliceDataset(torch.utils.data.IterableDataset):
             print(f'top neurite class: {self.label_map[c]}')
 
         examples, labels, classes = self.get_examples_from_top_class(
-            self.vol_relabeled, c, drop, self.label_map)
+            self.vol_relabeled, c, drop, self.label_map, self.label_index)
 
         # crop examples
         num_true = labels.count_nonzero()
@@ -456,7 +496,10 @@ class SliceDataset(torch.utils.data.IterableDataset):
                         dummy_x = torch.zeros_like(examples[0]).unsqueeze(0)
                         dummy_y = torch.zeros_like(labels[0]).unsqueeze(0)
                         labels = torch.cat((labels, dummy_y))
-                        examples = torch.cat((examples, dummy_x))
+                        if isinstance(examples, list):
+                            examples = examples + [dummy_x[0]]
+                        else:
+                            examples = torch.cat((examples, dummy_x))
                 else:
                     labels = labels[:self.truncate_candidates]
                     examples = examples[:self.truncate_candidates]
@@ -467,19 +510,21 @@ class SliceDataset(torch.utils.data.IterableDataset):
 
         self.cur_neurite_i += 1
         self.test_iteration_batch = (examples, labels, merge_info)
-        self.test_iteration_len = examples.shape[0]
+        self.test_iteration_len = len(examples)
         self.test_iteration_i = 0
 
-    def get_examples_from_top_class(self, vol, c, drop, label_map):
+    def get_examples_from_top_class(self, vol, c, drop, label_map, index):
+        """
+        index (LabelIndex): where each class lives in vol,
+                            every section is built inside of class bounding boxes rather than the full slice.
+        """
 
         top_c = c
         (sz, sy, sx) = vol.shape
 
-        # Find min and max z slice on which c occurs #
-        for i in range(sz):
-            if c in vol[i]:
-                zmin = i
-                break
+        # Find min z slice on which c occurs #
+        (zmin, _) = index.zrange(top_c)
+        (_, top_y, top_x) = index.bbox(top_c)
         # assert zmax - zmin >= num_slices + \
         #     2, f'zspan of neurite must be at least 2 slices bigger than num_slices to drop, zspan:{zmax - zmin}, num_slices:{num_slices}'
 
@@ -487,23 +532,24 @@ class SliceDataset(torch.utils.data.IterableDataset):
         num_slices = drop_end - drop_start
         top_z_len = min(self.context_slices, drop_start-zmin)
         bot_z_len = min(self.context_slices, sz-drop_end)
-
-        # Alloc final vol, we dont know how large it will be in y and x but we know max z #
         mz = num_slices + top_z_len + bot_z_len
-        final_vol = np.zeros((mz, sy, sx), dtype='uint')
 
         # Build top section #
-        top_vol_section = final_vol[0:top_z_len]
-        top_vol_section[vol[drop_start-top_z_len:drop_start] == top_c] = top_c
+        top_mask = vol[drop_start-top_z_len:drop_start, top_y, top_x] == top_c
+
+        # bottom neurites can only be within radius of the top neurite #
+        (win_y, win_x) = grow_bbox((top_y, top_x), self.radius, (sy, sx))
 
         # Get midpoint of neurite on 2D top cross section, #
-        top_border = top_vol_section[-1]
-        # use the relabeled top section
+        top_border = vol[drop_start-1, win_y, win_x].copy()
+        top_border[top_border != top_c] = 0
+        # use the relabeled top section, rounded in vol coordinates
         (com_x, com_y) = ndimage.measurements.center_of_mass(top_border)
-        (com_x, com_y) = round(com_x), round(com_y)
+        (com_x, com_y) = round(com_x + win_y.start) - \
+            win_y.start, round(com_y + win_x.start) - win_x.start
 
         # Find all neurites with distnce D from that point on bottom cross section #
-        bot_border = vol[drop_end].copy()  # need copy because we zero
+        bot_border = vol[drop_end, win_y, win_x].copy()  # need copy because we zero
         mask = circular_mask(
             bot_border.shape[0], bot_border.shape[1], center=(com_y, com_x), radius=self.radius)
         bot_border[~mask] = 0
@@ -511,26 +557,45 @@ class SliceDataset(torch.utils.data.IterableDataset):
         # DISTANCE SORT #
         # get classes in order of distance from top neurite for efficieny we just look at the top_border and bot_border stack
         d_vol = np.stack([top_border, bot_border])
-        d_vol = crop_where(d_vol, d_vol != 0)
         mismatch_classes = get_classes_sorted_by_distance(
             d_vol, top_c, method='mean')
 
-        final_vol[0: top_z_len] = top_vol_section
-        final_examples = torch.zeros(
-            (len(mismatch_classes), 3, self.num_points))
+        # rescaling needs the joint volume of each example, otherwise
+        # the top fragment boundary is extracted once and shared by all canidates
+        if self.scale is None:
+            top_cloud = convert_mask_to_boundary_cloud(
+                top_mask, offset=(0, top_y.start, top_x.start))
+
+        if self.num_points is not None:
+            final_examples = torch.zeros(
+                (len(mismatch_classes), 3, self.num_points))
+        else:
+            # full boundary clouds differ in size, see ShardWriter for how they are stored
+            final_examples = [None] * len(mismatch_classes)
         final_lables = []
         classes = []
         for i, bot_c in enumerate(mismatch_classes):
 
-            cur_vol = final_vol.copy()
             # Build bot section #
-            bot_vol_section = cur_vol[num_slices+top_z_len:]
-            bot_vol_section[vol[drop_end:drop_end+bot_z_len] == bot_c] = bot_c
+            (_, bot_y, bot_x) = index.bbox(bot_c)
+            bot_mask = vol[drop_end:drop_end+bot_z_len, bot_y, bot_x] == bot_c
 
-            # Build final volume of bottom sections #
-            cur_vol[num_slices+top_z_len:] = bot_vol_section
+            if self.scale is None:
+                bot_cloud = convert_mask_to_boundary_cloud(
+                    bot_mask, offset=(num_slices+top_z_len, bot_y.start, bot_x.start))
+                pc = self.convert_clouds_to_final(top_cloud, bot_cloud)
+            else:
+                # Alloc final vol just large enough in y and x for both sections #
+                (ex_y, ex_x) = union_bbox((top_y, top_x), (bot_y, bot_x))
+                origin = (ex_y.start, ex_x.start)
+                cur_vol = np.zeros(
+                    (mz, ex_y.stop-ex_y.start, ex_x.stop-ex_x.start), dtype='uint')
+                (ty, tx) = shift_bbox((top_y, top_x), origin)
+                (by, bx) = shift_bbox((bot_y, bot_x), origin)
+                cur_vol[0:top_z_len, ty, tx][top_mask] = top_c
+                cur_vol[num_slices+top_z_len:, by, bx][bot_mask] = bot_c
+                pc = self.convert_volumetric_to_final(cur_vol)
 
-            pc = self.convert_volumetric_to_final(cur_vol)
             final_examples[i] = pc
             label = int(label_map[top_c] == label_map[bot_c])
             final_lables.append(label)
@@ -552,6 +617,10 @@ class SliceDataset(torch.utils.data.IterableDataset):
     def convert_to_point_cloud(self, vol):
 
         pc = convert_grid_to_pointcloud(vol)
+        return self.sample_point_cloud(pc)
+
+    def sample_point_cloud(self, pc):
+
         if self.num_points is not None:
             num_points = pc.shape[0]
 
@@ -562,6 +631,10 @@ class SliceDataset(torch.utils.data.IterableDataset):
             else:
                 pc = random_sample_arr(pc, count=self.num_points)
 
+        if self.fps_points:
+            pc = farthest_points_first(
+                pc, npoint=self.fps_points, scale=self.fps_normalize)
+
         return pc
 
     def convert_volumetric_to_final(self, vol_example):
@@ -583,6 +656,20 @@ class SliceDataset(torch.utils.data.IterableDataset):
 
         # convert to point cloud
         pc_example = self.convert_to_point_cloud(vol_example)
+
+        return self.convert_point_cloud_to_final(pc_example)
+
+    def convert_clouds_to_final(self, *clouds):
+
+        # joining the boundary clouds is equivalent to the crop
+        # and interior removal of the volumetric example
+        pc_example = join_boundary_clouds(*clouds)
+        pc_example = self.sample_point_cloud(pc_example)
+
+        return self.convert_point_cloud_to_final(pc_example)
+
+    def convert_point_cloud_to_final(self, pc_example):
+
         if self.Augmentor is not None:
             pc_example = self.Augmentor.transfrom(pc_example)
         pc_example = np.swapaxes(pc_example, 0, 1)
@@ -592,39 +679,81 @@ class SliceDataset(torch.utils.data.IterableDataset):
         return pc_example
 
     def build_merge_information(self, classes, labels):
+        # one record per candidate, see INFO_DTYPE
         drop_start, drop_end = self.get_cur_drop()
-        infos = []
-        for lbl, cl in zip(labels, classes):
-            info = {'top_class': cl[0], 'bot_class': cl[1], 'drop_start': drop_start,
-                    'drop_end': drop_end, 'volume_i': self.cur_vol_i, 'label': bool(lbl.item())}
-            infos.append(info)
+        infos = np.zeros(len(classes), dtype=INFO_DTYPE)
+        if len(classes) > 0:
+            classes = np.asarray(classes)
+            infos['top_class'] = classes[:, 0]
+            infos['bot_class'] = classes[:, 1]
+        infos['drop_start'] = drop_start
+        infos['drop_end'] = drop_end
+        infos['volume_i'] = self.cur_vol_i
+        infos['label'] = labels[:len(classes)].numpy() != 0
         return infos
 
-    def get_drop_start_range(self):
-        # point at each drop end cannot exceede
-        cur_vol = self.get_cur_vol()
-        range_start = self.context_slices
-        range_stop = cur_vol.shape[0] - self.num_slices - self.context_slices
-        # for worker parallelization set drop_end_max by drop_start_worker_range
-        if self.drop_start_worker_range is not None:
-            range_start, range_stop = self.drop_start_worker_range
-
-        return (range_start, range_stop)
-
-    def increment_vol_and_drop(self):
+    def get_units(self):
+        """
+        Runs of drops_per_unit consecutive drops of a volume, each drop with every one of its gap sizes, as (volume_i, drop_start, num_slices).
+        A worker takes a whole run, so the gap sizes of a drop share its top side and neighbouring drops share bottom ranges.
+        Each vol uses its own z extent.
+        """
+        units = []
+        for vol_i, vol in enumerate(self.vols):
+            drops = []
+            for drop_start in range(self.context_slices, vol.shape[0] - self.context_slices):
+                drop = [(vol_i, drop_start, num_slices) for num_slices in self.all_num_slices
+                        if drop_start + num_slices + self.context_slices < vol.shape[0]
+                        and (vol_i, drop_start, num_slices) not in self.skip_units]
+                if len(drop) > 0:
+                    drops.append(drop)
+            for i in range(0, len(drops), self.drops_per_unit):
+                units.append([u for drop in drops[i:i+self.drops_per_unit] for u in drop])
+        return units
+
+    def begin_pass(self, num_workers):
+        """
+        Join the current pass as one of its num_workers workers and return its id, pass ids only ever increase.
+        The last worker to finish a pass starts the next one (see steal_units), a pass abandoned before
+        all of its workers finished is replaced once every one of them has started again.
+        """
+        counter = self.unit_counter
+        with counter.get_lock():
+            if counter[4] > 0 and counter[2] >= counter[4]:
+                counter[0] += 1
+                counter[1] = counter[2] = counter[3] = 0
+            if counter[2] == 0:
+                counter[4] = num_workers
+            counter[2] += 1
+            return counter[0]
+
+    def steal_units(self, units, pass_id):
+        """
+        Hand out units to whichever worker asks next, so no worker idles while others still have work.
+        Workers still on an older pass than pass_id stop.
+        """
+        counter = self.unit_counter
+        while True:
+            with counter.get_lock():
+                if counter[0] != pass_id:
+                    return
+                i = counter[1]
+                counter[1] += 1
+                if i >= len(units):
+                    counter[3] += 1
+                    if counter[3] == counter[4]:
+                        # the last worker out starts the next pass
+                        counter[0] += 1
+                        counter[1] = counter[2] = counter[3] = counter[4] = 0
+                    return
+            yield units[i]
+
+    def next_unit(self):
+        # raises StopIteration once there are no units left
+        (self.cur_vol_i, self.cur_drop_start, self.num_slices) = next(self.units)
         if self.verbose:
-            print('increment drop')
-        self.cur_drop_start += 1
-        range_start, range_stop = self.get_drop_start_range()
-
-        # if we have reached the end of the vol, do to next vol
-        if self.cur_drop_start >= range_stop:
-            self.cur_vol_i += 1
-            self.cur_drop_start = range_start
-            if self.verbose:
-                print('increment vol')
-            if self.cur_vol_i >= len(self.vols):
-                raise StopIteration
+            print(
+                f'worker: {self.worker_id}, vol: {self.cur_vol_i}, drop_start: {self.cur_drop_start}, num_slices: {self.num_slices}')
 
     def get_cur_vol(self):
         return self.vols[self.cur_vol_i]
@@ -658,17 +787,12 @@ class SliceDataset(torch.utils.data.IterableDataset):
 
         return x, y, i
 
-    def build_generator(self, drop_start_worker_range=None):
-        # for worker parallelization
-        self.drop_start_worker_range = drop_start_worker_range
-        if drop_start_worker_range is not None:
-            worker_info = torch.utils.data.get_worker_info()
-            print(
-                f'worker_id: {worker_info.id}, drop_start_worker_range: {drop_start_worker_range}')
-            self.worker_id = worker_info.id
-
-        range_start, _ = self.get_drop_start_range()
-        self.cur_drop_start = range_start
+    def build_generator(self, units):
+        self.units = units
+        self.top_neurites = np.zeros((0))
+        self.cur_neurite_i = 0
+        self.test_iteration_i = 0
+        self.test_iteration_len = 0
         # generator
         while True:
             try:
@@ -677,25 +801,15 @@ class SliceDataset(torch.utils.data.IterableDataset):
                 return
 
     def __iter__(self):
+        units = self.get_units()
         worker_info = torch.utils.data.get_worker_info()
         if worker_info is None:  # single-process data loading, return the full iterator
-            return self.build_generator()
+            return self.build_generator(itertools.chain.from_iterable(units))
         else:  # in a worker process
-            vol = self.get_cur_vol()  # assumes vols all same shape on z
-            start, end = self.context_slices, vol.shape[0] - \
-                self.num_slices - self.context_slices
-            # split workload
-            per_worker = int(
-                math.ceil((end - start) / float(worker_info.num_workers)))
-            worker_id = worker_info.id
-            iter_start = start + worker_id * per_worker
-            iter_end = min(iter_start + per_worker, end)
-            drop_start_worker_range = (iter_start, iter_end)
-            if iter_start >= iter_end:
-                # print(
-                #     f'too many workers, not using worker {worker_id}')
-                return iter(())
-            return self.build_generator(drop_start_worker_range=drop_start_worker_range)
+            self.worker_id = worker_info.id
+            # every worker starts a new iterator for each pass of a DataLoader, persistent or not
+            pass_id = self.begin_pass(worker_info.num_workers)
+            return self.build_generator(itertools.chain.from_iterable(self.steal_units(units, pass_id)))
 
 
 @click.command()
@@ -714,6 +828,7 @@ class SliceDataset(torch.utils.data.IterableDataset):
               )
 @click.option('--num_points', '-np',
               type=int, default=2048,
+              help='points sampled for each example, 0 stores the full boundary clouds to sample any number from at load time'
               )
 @click.option('--radius', '-r',
               type=int, default=96,
@@ -730,69 +845,88 @@ class SliceDataset(torch.utils.data.IterableDataset):
               type=int, default=-1,
               help='num workers for pytorch dataloader. -1 means automatically set.'
               )
-def generate_dataset(output_dir: str, multiple: bool, context_slices: int, num_points: int, radius: int, truncate_candidates: int, scale: int, num_workers: int):
-
-    for num_slices in [9, 10, 11, 12]:
-
-        name = f'aligned_ns={num_slices}_cs={context_slices}'
-
-        # auto set
-        if num_workers == -1:
-            num_workers = get_cpu_count()
-        batch_size = 1
-
-        # file management
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        file_path = f'{output_dir}/DATASET_{name}'
-
-        print(
-            f'\nname {name}\nbatch_size {batch_size}, num_workers {num_workers}')
+@click.option('--shard_size', '-ss',
+              type=int, default=1000,
+              help='min number of canidate groups per shard'
+              )
+@click.option('--fps_points', '-fps',
+              type=int, default=0,
+              help='points of each cloud to store in farthest point order, its prefixes are then farthest point samples at load time. 0 for none'
+              )
+@click.option('--share_vols/--no-share_vols',
+              default=False,
+              help='copy volumes which are not memory mapped into shared memory (/dev/shm) for the workers to attach to'
+              )
+@click.option('--resume/--no-resume',
+              default=True,
+              help='skip the (volume, drop) units already written to the output'
+              )
+@click.option('--num_slices', '-ns',
+              type=int, multiple=True, default=[9, 10, 11, 12],
+              help='gap sizes to drop, a dataset is written for each in the same pass'
+              )
+def generate_dataset(output_dir: str, multiple: bool, context_slices: int, num_points: int, radius: int, truncate_candidates: int, scale: int, num_workers: int, shard_size: int, fps_points: int, share_vols: bool, resume: bool, num_slices: List[int]):
+
+    # auto set
+    if num_workers == -1:
+        num_workers = get_cpu_count()
+    batch_size = 1
+    # full clouds, sampled at load time
+    if num_points == 0:
+        num_points = None
+
+    # everything which changes the examples, resuming into shards generated with other values is refused
+    params = {'multiple': multiple, 'context_slices': context_slices, 'num_points': num_points, 'radius': radius,
+              'truncate_candidates': truncate_candidates, 'scale': scale, 'fps_points': fps_points}
+
+    # file management
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    file_paths = {ns: f'{output_dir}/DATASET_aligned_ns={ns}_cs={context_slices}'
+                  for ns in num_slices}
+
+    print(
+        f'\nnum_slices {list(num_slices)}\nbatch_size {batch_size}, num_workers {num_workers}')
+    for file_path in file_paths.values():
         print(f'file_path {file_path}')
 
-        print(f'loading volumes...')
-        validation_slices = 16
-        print('validation_slices', validation_slices)
-        train_vols, val_vols, test_vols = prepare_corrected_cremi_vols(
-            '/mnt/home/jberman/sc/proofreader/dataset/cremi/corrected', validation_slices=validation_slices)
-
-        for vols, name in zip([train_vols, val_vols, test_vols], ['train', 'val', 'test']):
-            print(f'{name} shapes')
-            for v in vols:
-                print(v.shape, end=' ')
-            print('')
-
-        torch.multiprocessing.set_sharing_strategy('file_system')
-        for vols, name in zip([val_vols, train_vols, test_vols], ['val', 'train', 'test']):
-            print(f'generating data for {name} set...')
-
-            dataset = SliceDataset(vols, num_slices, radius, context_slices, num_points=num_points, allow_multiple=multiple, scale=scale,
-                                   Augmentor=None, truncate_candidates=truncate_candidates, candidate_group=True, verbose=False)
-
-            def collate_fn(data):
-                assert len(data) == 1, 'only supports batch_size of 1'
-                return data[0]
-
-            iterator = DataLoader(
-                dataset=dataset, batch_size=batch_size, num_workers=num_workers, drop_last=False, collate_fn=collate_fn)
-
-            all_x, all_y, all_i = [], [], []
-            for step, batch in tqdm(enumerate(iterator)):
-                x, y, i = batch
-                all_x.append(x)
-                all_y.append(y)
-                all_i.append(i)
-
-            # set candidate id
-            for i in range(len(all_y)):
-                by = all_y[i]
-                bid = torch.zeros_like(by) + i
-                all_y[i] = torch.stack((by, bid), dim=1)
-
-            print(f'saving batches...')
-            torch.save((all_x, all_y, all_i), f'{file_path}_{name}.pt')
-            print(f'x: {len(all_x)} y: {len(all_y)}')
-            print(f'finished {name}!')
+    # the volumes are loaded and cleaned once for every gap size
+    print(f'loading volumes...')
+    validation_slices = 16
+    print('validation_slices', validation_slices)
+    train_vols, val_vols, test_vols = prepare_corrected_cremi_vols(
+        '/mnt/home/jberman/sc/proofreader/dataset/cremi/corrected', validation_slices=validation_slices)
+
+    for vols, name in zip([train_vols, val_vols, test_vols], ['train', 'val', 'test']):
+        print(f'{name} shapes')
+        for v in vols:
+            print(v.shape, end=' ')
+        print('')
+
+    torch.multiprocessing.set_sharing_strategy('file_system')
+    if share_vols:
+        # placed in shared memory once, workers only attach to them
+        train_vols, val_vols, test_vols = [share_volumes(
+            vols) for vols in [train_vols, val_vols, test_vols]]
+    for vols, name in zip([val_vols, train_vols, test_vols], ['val', 'train', 'test']):
+        print(f'generating data for {name} set...')
+
+        dataset = SliceDataset(vols, num_slices, radius, context_slices, num_points=num_points, allow_multiple=multiple, scale=scale,
+                               Augmentor=None, truncate_candidates=truncate_candidates, candidate_group=True, verbose=False,
+                               fps_points=fps_points)
+
+        # each worker writes its own shards, only the manifests are kept here
+        paths = {ns: f'{file_path}_{name}' for ns,
+                 file_path in file_paths.items()}
+        manifests = write_shards(dataset, paths, shard_size=shard_size,
+                                 num_workers=num_workers, resume=resume, params=params)
+        for ns, manifest in manifests.items():
+            num_groups = sum(shard['groups'] for shard in manifest['shards'])
+            num_examples = sum(shard['examples']
+                               for shard in manifest['shards'])
+            print(
+                f'ns {ns} shards: {len(manifest["shards"])} groups: {num_groups} examples: {num_examples}')
+        print(f'finished {name}!')
 
 
 if __name__ == '__main__':
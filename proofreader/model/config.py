@@ -1,3 +1,4 @@
+import os
 import numpy as np
 import pprint
 from typing import Tuple
@@ -7,7 +8,8 @@ import torch
 import torch.nn.functional as F
 from torch.optim.lr_scheduler import CosineAnnealingLR
 
-from proofreader.data.augment import Augmentor
+from proofreader.data.augment import Augmentor, BatchAugmentor
+from proofreader.data.shards import load_shards, open_shards, get_truncated_index, dataset_split_path, RaggedArray, infos_to_records, read_summary, write_summary, read_fps_order
 from proofreader.model.pointnet import PointNet
 from proofreader.model.curvenet import CurveNet
 from proofreader.model.transnet import PointTransformerCls
@@ -21,6 +23,12 @@ class AugmentorConfig:
     random_scale: bool = False
     normalize: tuple = (125, 1250, 1250)
     num_points: int = None
+    rotate_z: bool = False
+    perturb_rotation: bool = False
+    jitter: bool = False
+    # augment whole batches at collate (BatchAugmentor), or on the training device
+    batched: bool = False
+    on_device: bool = False
 
 
 @dataclass
@@ -36,6 +44,10 @@ class DatasetConfig:
     truncate_canidates: int = 4
     scale: bool = False
     balance_samples: bool = False
+    # clouds generated with fps_points are sampled by prefix and the models use their order instead of sampling
+    fps_order: bool = False
+    # keep the whole dataset on the training device and batch by index gather (DeviceDataLoader), augmenting there
+    in_memory: bool = False
 
 
 @dataclass
@@ -66,23 +78,39 @@ class ExperimentConfig:
 def load_dataset_from_disk(dataset_config, aug_config, test=False):
 
     # build augmentor
-    train_augmentor = Augmentor(center=aug_config.center, shuffle=aug_config.shuffle, normalize=aug_config.normalize, num_points=dataset_config.num_points,
-                                random_scale=aug_config.random_scale)
+    # in memory datasets are augmented on device, a batch at a time
+    on_device = aug_config.on_device or dataset_config.in_memory
+    if aug_config.batched or dataset_config.in_memory:
+        train_augmentor = BatchAugmentor(center=aug_config.center, shuffle=aug_config.shuffle, normalize=aug_config.normalize, num_points=dataset_config.num_points,
+                                         random_scale=aug_config.random_scale, rotate_z=aug_config.rotate_z, perturb_rotation=aug_config.perturb_rotation,
+                                         jitter=aug_config.jitter, on_device=on_device,
+                                         fps_order=dataset_config.fps_order)
+
+        test_augmentor = BatchAugmentor(center=aug_config.center, shuffle=aug_config.shuffle, normalize=aug_config.normalize, num_points=dataset_config.num_points,
+                                        random_scale=False, on_device=on_device, fps_order=dataset_config.fps_order)
+    else:
+        train_augmentor = Augmentor(center=aug_config.center, shuffle=aug_config.shuffle, normalize=aug_config.normalize, num_points=dataset_config.num_points,
+                                    random_scale=aug_config.random_scale, rotate_z=aug_config.rotate_z, perturb_rotation=aug_config.perturb_rotation,
+                                    jitter=aug_config.jitter, fps_order=dataset_config.fps_order)
 
-    test_augmentor = Augmentor(center=aug_config.center, shuffle=aug_config.shuffle, normalize=aug_config.normalize, num_points=dataset_config.num_points,
-                               random_scale=False)
+        test_augmentor = Augmentor(center=aug_config.center, shuffle=aug_config.shuffle, normalize=aug_config.normalize, num_points=dataset_config.num_points,
+                                   random_scale=False, fps_order=dataset_config.fps_order)
 
     path = dataset_config.path
+    if dataset_config.fps_order:
+        for split in ['train', 'val', 'test']:
+            check_fps_order(dataset_split_path(path, split),
+                            dataset_config.num_points, aug_config.normalize)
 
     val_dataset = build_dataset_from_path(
-        f'{path}_val.pt', truncate_canidates=dataset_config.truncate_canidates, merge_canidates=True, augmentor=test_augmentor, use_info=True)
+        dataset_split_path(path, 'val'), truncate_canidates=dataset_config.truncate_canidates, merge_canidates=True, augmentor=test_augmentor, use_info=True)
     test_dataset = build_dataset_from_path(
-        f'{path}_test.pt', truncate_canidates=dataset_config.truncate_canidates, merge_canidates=True, augmentor=test_augmentor, use_info=True)
+        dataset_split_path(path, 'test'), truncate_canidates=dataset_config.truncate_canidates, merge_canidates=True, augmentor=test_augmentor, use_info=True)
 
     # for quicker load
     if not test:
         train_dataset = build_dataset_from_path(
-            f'{path}_train.pt', truncate_canidates=dataset_config.truncate_canidates, merge_canidates=True, augmentor=train_augmentor)
+            dataset_split_path(path, 'train'), truncate_canidates=dataset_config.truncate_canidates, merge_canidates=True, augmentor=train_augmentor)
     else:
         train_dataset = val_dataset
 
@@ -91,48 +119,48 @@ def load_dataset_from_disk(dataset_config, aug_config, test=False):
     return train_dataset, val_dataset, test_dataset
 
 
-def build_dataset_from_path(path, truncate_canidates, merge_canidates, augmentor=None, use_info=False):
+def check_fps_order(path, num_points, normalize):
+    # prefixes are only farthest point samples if enough of each cloud was ordered, in the same space the augmentor normalizes to
+    assert os.path.isdir(path), f'{path} is not sharded, farthest point order is only stored in shards'
+    (fps_points, fps_normalize) = read_fps_order(path)
+    assert fps_points > 0, f'{path} was generated without fps_points'
+    assert num_points is None or num_points <= fps_points, f'only {fps_points} points are in farthest point order, need {num_points}'
+    assert normalize is not None and np.allclose(fps_normalize, normalize), \
+        f'farthest point order was measured with normalize {fps_normalize}, not {normalize}'
 
-    x, y, info = torch.load(path)
 
-    stats = {}
-    # number of total neurites we attempt to merge
-    stats['total_neurites'] = len(y)
-    # number of total times we should merge before truncation of canidates
-    stats['merge_opportunities'] = 0
-    # the reducation in total possible success rate due to the inital truncation
-    stats['truncate_succ_loss'] = 0
-    stats['truncated_total_examples'] = 0
-    stats['truncated_positive_examples'] = 0
-    stats['truncated_negative_examples'] = 0
-    stats['multi_merge'] = 0
-    stats['truncated_multi_merge'] = 0
-    for i in range(len(x)):
-        mo = torch.sum(y[i][:, 0]).item()
-        stats['merge_opportunities'] += mo
-        stats['multi_merge'] += int(mo > 1)
-        if truncate_canidates != 0:
-            if len(y[i][truncate_canidates:]) > 0:
-                stats['truncate_succ_loss'] += torch.sum(
-                    y[i][truncate_canidates:][:, 0]).item()
-            x[i] = x[i][:truncate_canidates]
-            y[i] = y[i][:truncate_canidates]
-            info[i] = info[i][:truncate_canidates]
-
-        pe = (y[i][:, 0] == 1).count_nonzero().item()
-        ne = (y[i][:, 0] == 0).count_nonzero().item()
-        stats['truncated_total_examples'] += y[i].shape[0]
-        stats['truncated_positive_examples'] += pe
-        stats['truncated_negative_examples'] += ne
-        stats['truncated_multi_merge'] += int(pe > 1)
+def build_dataset_from_path(path, truncate_canidates, merge_canidates, augmentor=None, use_info=False):
 
-    stats['truncate_succ_loss'] /= stats['merge_opportunities']
-    stats['truncated_positive_examples'] /= stats['truncated_total_examples']
-    stats['truncated_negative_examples'] /= stats['truncated_total_examples']
+    # sharded datasets are read lazily, only the labels are loaded
+    if os.path.isdir(path) and merge_canidates:
+        return build_mapped_dataset_from_path(path, truncate_canidates, augmentor=augmentor, use_info=use_info)
+
+    if os.path.isdir(path):
+        x, y, info = load_shards(path)
+    else:
+        x, y, info = torch.load(path)
+
+    # the labels and group offsets are all the stats need, kept in a sidecar for the next load
+    summary = read_summary(path)
+    if summary is None:
+        summary = (torch.cat([g[:, 0] for g in y]).numpy(),
+                   np.cumsum([0] + [len(g) for g in y]))
+        write_summary(path, *summary)
+    (labels, offsets) = summary
+    _, _, kept = get_truncated_index(offsets, truncate_canidates)
+    stats = get_merge_stats(labels, offsets, kept)
+
+    if truncate_canidates != 0:
+        x = [g[:k] for g, k in zip(x, kept)]
+        y = [g[:k] for g, k in zip(y, kept)]
+        info = [g[:k] for g, k in zip(info, kept)]
 
     if merge_canidates:
         x, y = torch.cat(x), torch.cat(y)
-        info = np.array(sum(info, []))
+        # old single file datasets hold lists of info dicts
+        info = np.concatenate(info) if isinstance(
+            info[0], np.ndarray) else [i for group in info for i in group]
+        info = infos_to_records(info, bid=y[:, 1].numpy())
 
     if not use_info:
         info = None
@@ -145,6 +173,59 @@ def build_dataset_from_path(path, truncate_canidates, merge_canidates, augmentor
     return ds
 
 
+def build_mapped_dataset_from_path(path, truncate_canidates, augmentor=None, use_info=False):
+
+    x, labels, info, offsets = open_shards(path)
+    if isinstance(x, RaggedArray):
+        assert augmentor is not None and augmentor.num_points is not None, \
+            'dataset has full clouds, set num_points so they are sampled at load time'
+    index, bid, kept = get_truncated_index(offsets, truncate_canidates)
+    stats = get_merge_stats(labels, offsets, kept)
+
+    y = torch.from_numpy(np.stack((labels[index], bid), axis=1))
+
+    if use_info:
+        # the info of every example with its canidate group, read once rather than per item
+        info = infos_to_records(info[:], bid=np.repeat(
+            np.arange(len(offsets)-1), np.diff(offsets)))
+    else:
+        info = None
+
+    ds = DatasetWithInfo(x, y, info=info, shuffle=False,
+                         augmentor=augmentor, stats=stats, index=index)
+
+    print(path, stats)
+
+    return ds
+
+
+def get_merge_stats(labels, offsets, kept):
+    """
+    Merge stats from the labels of every canidate group (split by offsets)
+    and the number of examples kept in each after truncation.
+    """
+    # positives in each group, and in the kept part of each group
+    csum = np.concatenate(([0], np.cumsum(labels == 1)))
+    pos = csum[offsets[1:]] - csum[offsets[:-1]]
+    kept_pos = csum[offsets[:-1] + kept] - csum[offsets[:-1]]
+
+    stats = {}
+    stats['total_neurites'] = len(kept)
+    stats['merge_opportunities'] = int(labels.sum())
+    stats['truncate_succ_loss'] = int(pos.sum() - kept_pos.sum())
+    stats['truncated_total_examples'] = int(kept.sum())
+    stats['truncated_positive_examples'] = int(kept_pos.sum())
+    stats['truncated_negative_examples'] = int(kept.sum() - kept_pos.sum())
+    stats['multi_merge'] = int((pos > 1).sum())
+    stats['truncated_multi_merge'] = int((kept_pos > 1).sum())
+
+    stats['truncate_succ_loss'] /= stats['merge_opportunities']
+    stats['truncated_positive_examples'] /= stats['truncated_total_examples']
+    stats['truncated_negative_examples'] /= stats['truncated_total_examples']
+
+    return stats
+
+
 def build_full_model_from_config(model_config: ModelConfig, dataset_config: DatasetConfig, epochs):
     # loss
     if model_config.loss == 'nll':
@@ -63,19 +63,25 @@ class CurveNet(nn.Module):
         self.bn1 = nn.BatchNorm1d(512)
         self.dp1 = nn.Dropout(p=0.5)
 
-    def forward(self, xyz):
+    def forward(self, xyz, fps_idx=None):
+        """
+        fps_idx: optional precomputed farthest point order of xyz, [B, >=1024], used instead of sampling in the model
+        """
         l0_points = self.lpfa(xyz, xyz)
 
-        l1_xyz, l1_points = self.cic11(xyz, l0_points)
+        l1_xyz, l1_points = self.cic11(xyz, l0_points, fps_idx)
+        fps_idx = pooled_fps_idx(fps_idx, xyz, l1_xyz)
         l1_xyz, l1_points = self.cic12(l1_xyz, l1_points)
 
-        l2_xyz, l2_points = self.cic21(l1_xyz, l1_points)
+        l2_xyz, l2_points = self.cic21(l1_xyz, l1_points, fps_idx)
+        fps_idx = pooled_fps_idx(fps_idx, l1_xyz, l2_xyz)
         l2_xyz, l2_points = self.cic22(l2_xyz, l2_points)
 
-        l3_xyz, l3_points = self.cic31(l2_xyz, l2_points)
+        l3_xyz, l3_points = self.cic31(l2_xyz, l2_points, fps_idx)
+        fps_idx = pooled_fps_idx(fps_idx, l2_xyz, l3_xyz)
         l3_xyz, l3_points = self.cic32(l3_xyz, l3_points)
 
-        l4_xyz, l4_points = self.cic41(l3_xyz, l3_points)
+        l4_xyz, l4_points = self.cic41(l3_xyz, l3_points, fps_idx)
         l4_xyz, l4_points = self.cic42(l4_xyz, l4_points)
 
         x = self.conv0(l4_points)
@@ -201,7 +207,24 @@ def query_ball_point(radius, nsample, xyz, new_xyz):
     return group_idx
 
 
-def sample_and_group(npoint, radius, nsample, xyz, points, returnfps=False):
+def pooled_fps_idx(fps_idx, xyz, new_xyz):
+    """
+    Pooled points keep the order they were sampled in, and any prefix of a farthest point
+    order is a farthest point sample, so after pooling the order is just the prefix
+    Input:
+        fps_idx: farthest point order of xyz, [B, M] or None
+        xyz: points before pooling, [B, 3, N]
+        new_xyz: points after pooling, [B, 3, S]
+    Return:
+        fps_idx: farthest point order of new_xyz, [B, S] or None
+    """
+    if fps_idx is None or xyz.size(-1) == new_xyz.size(-1):
+        return fps_idx
+    B, _, S = new_xyz.shape
+    return torch.arange(S, dtype=torch.long, device=new_xyz.device).expand(B, S)
+
+
+def sample_and_group(npoint, radius, nsample, xyz, points, returnfps=False, fps_idx=None):
     """
     Input:
         npoint:
@@ -209,11 +232,14 @@ def sample_and_group(npoint, radius, nsample, xyz, points, returnfps=False):
         nsample:
         xyz: input points position data, [B, N, 3]
         points: input points data, [B, N, D]
+        fps_idx: optional precomputed farthest point order of xyz, [B, >=npoint]
     Return:
         new_xyz: sampled points position data, [B, npoint, nsample, 3]
         new_points: sampled points data, [B, npoint, nsample, 3+D]
     """
-    new_xyz = index_points(xyz, farthest_point_sample(xyz, npoint))
+    if fps_idx is None:
+        fps_idx = farthest_point_sample(xyz, npoint)
+    new_xyz = index_points(xyz, fps_idx[:, :npoint])
     # torch.cuda.empty_cache()
 
     idx = query_ball_point(radius, nsample, xyz, new_xyz)
@@ -441,12 +467,12 @@ class CIC(nn.Module):
 
         self.lpfa = LPFA(planes, planes, k, mlp_num=mlp_num, initial=False)
 
-    def forward(self, xyz, x):
+    def forward(self, xyz, x, fps_idx=None):
 
         # max pool
         if xyz.size(-1) != self.npoint:
             xyz, x = self.maxpool(
-                xyz.transpose(1, 2).contiguous(), x)
+                xyz.transpose(1, 2).contiguous(), x, fps_idx)
             xyz = xyz.transpose(1, 2)
 
         shortcut = x
@@ -575,9 +601,9 @@ class MaskedMaxPool(nn.Module):
         self.radius = radius
         self.k = k
 
-    def forward(self, xyz, features):
+    def forward(self, xyz, features, fps_idx=None):
         sub_xyz, neighborhood_features = sample_and_group(
-            self.npoint, self.radius, self.k, xyz, features.transpose(1, 2))
+            self.npoint, self.radius, self.k, xyz, features.transpose(1, 2), fps_idx=fps_idx)
 
         neighborhood_features = neighborhood_features.permute(
             0, 3, 1, 2).contiguous()
@@ -3,11 +3,14 @@ import torch.nn as nn
 from proofreader.model.classifier import *
 
 
-def sample_and_group(npoint, nsample, xyz, points):
+def sample_and_group(npoint, nsample, xyz, points, fps_idx=None):
     B, N, C = xyz.shape
     S = npoint
 
-    fps_idx = farthest_point_sample(xyz, npoint)  # [B, npoint]
+    if fps_idx is None:
+        fps_idx = farthest_point_sample(xyz, npoint)  # [B, npoint]
+    else:
+        fps_idx = fps_idx[:, :npoint]  # precomputed order, any prefix is a sample
 
     new_xyz = index_points(xyz, fps_idx)
     new_points = index_points(points, fps_idx)
@@ -134,7 +137,10 @@ class PointTransformerCls(nn.Module):
         self.dp2 = nn.Dropout(p=0.5)
         self.linear3 = nn.Linear(256, output_channels)
 
-    def forward(self, x):
+    def forward(self, x, fps_idx=None):
+        """
+        fps_idx: optional precomputed farthest point order of x, [B, >=512], used instead of sampling in the model
+        """
         x = x.permute(0, 2, 1)
         xyz = x[..., :3]
         x = x.permute(0, 2, 1)
@@ -143,11 +149,15 @@ class PointTransformerCls(nn.Module):
         x = self.relu(self.bn2(self.conv2(x)))  # B, D, N
         x = x.permute(0, 2, 1)
         new_xyz, new_feature = sample_and_group(
-            npoint=512, nsample=32, xyz=xyz, points=x)
+            npoint=512, nsample=32, xyz=xyz, points=x, fps_idx=fps_idx)
         feature_0 = self.gather_local_0(new_feature)
         feature = feature_0.permute(0, 2, 1)
+        # sampled points are in farthest point order, so the next sample is a prefix
+        if fps_idx is not None:
+            fps_idx = torch.arange(
+                new_xyz.shape[1], device=new_xyz.device).expand(batch_size, -1)
         new_xyz, new_feature = sample_and_group(
-            npoint=256, nsample=32, xyz=new_xyz, points=feature)
+            npoint=256, nsample=32, xyz=new_xyz, points=feature, fps_idx=fps_idx)
         feature_1 = self.gather_local_1(new_feature)
 
         x = self.pt_last(feature_1)
@@ -3,6 +3,7 @@ from proofreader.utils.vis import *
 import numpy as np
 from proofreader.data.cremi import prepare_cremi_vols
 from proofreader.run.log import plot_voi_curve
+from proofreader.data.shards import infos_to_records
 from torch.utils.tensorboard import SummaryWriter
 import os
 from collections import defaultdi
@@ -28,12 +29,10 @@ def test_baseline(num_slices, vols):
     dglobal = defaultdict(list)
 
     # build info and y_hats doing merge first method
-    infos = []
+    infos = infos_to_records([info_batch[0]
+                              for info_batch in I], bid=np.arange(len(I)))
     y_hats = np.zeros((len(I), 2))
-    for index, info_batch in enumerate(I):
-        infos.append(info_batch[0])
-        y_hats[index] = np.array([0.0, 1.0])
-    infos = np.array(infos)
+    y_hats[:] = np.array([0.0, 1.0])
 
     # do voi
     plot_voi_curve(vols, infos, y_hats, thresholds,
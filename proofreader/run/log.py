@@ -135,15 +135,20 @@ def plot_voi_curve(vols, infos, y_hats, thresholds, num_slices, writer, dglobal,
 def do_voi(args):
     vols, infos, y_hats, threshold, num_slices = args
 
-    # first init for all vols and drops
-    grouped = defaultdict(dict)  # 'vol_i' -> 'drop_start' -> [infos]
-    for info in infos:
-        grouped[info['volume_i']][info['drop_start']] = []
+    # infos is a structured array of merge info (MERGE_INFO_DTYPE), one key per drop
+    span = int(infos['drop_start'].max(initial=0)) + 1
+    keys = infos['volume_i'] * span + infos['drop_start']
     # select infos according to y_hats and threshold
-    true_infos = infos[y_hats[:, 1] > threshold]
-    # then add for just true infos
-    for info in true_infos:
-        grouped[info['volume_i']][info['drop_start']].append(info)
+    is_true = y_hats[:, 1] > threshold
+    order = np.argsort(keys[is_true], kind='stable')
+    true_infos, true_keys = infos[is_true][order], keys[is_true][order]
+    # every vol and drop, with just its true infos
+    grouped = defaultdict(dict)  # 'vol_i' -> 'drop_start' -> true infos
+    drop_keys = np.unique(keys)
+    starts = np.searchsorted(true_keys, drop_keys, side='left')
+    ends = np.searchsorted(true_keys, drop_keys, side='right')
+    for key, s, e in zip(drop_keys, starts, ends):
+        grouped[int(key // span)][int(key % span)] = true_infos[s:e]
 
     # get total voi
     split_total, merge_total, arand_total = 0, 0, 0
@@ -172,11 +177,12 @@ def do_voi(args):
 
 def compute_voi_for_drop(args):
     vol, drop_start, drop_end, true_infos = args
-    max_l = int(np.max(vol))*4
+    # create gt segmentation and split segmentation
+    # voi is over the whole vol so lazy vols (H5Volume) are read in full here
+    gt = np.array(vol)  # avoid label collision with wrong, right, none
+    max_l = int(np.max(gt))*4
     wrong, right, neither, bound = max_l, max_l+1, max_l+2, 0
 
-    # create gt segmentation and split segmentation
-    gt = vol.copy()  # avoid label collision with wrong, right, none
     gt[drop_start:drop_end] = 0  # drop slices from gt
     zeros = gt == 0  # retain zero mask
     z_btop = gt[drop_start - 1] == 0
@@ -185,12 +191,9 @@ def compute_voi_for_drop(args):
     offset = int(np.max(gt))+1  # relabel bot section for split
     split[drop_end:] += offset
 
-    merges = []
-    for info in true_infos:
-        # get merge classes in relabel bot section
-        top_c = info['top_class']
-        bot_c = info['bot_class'] + offset
-        merges.append([top_c, bot_c])
+    # get merge classes in relabel bot section
+    merges = np.stack((true_infos['top_class'],
+                       true_infos['bot_class'] + offset), axis=1).tolist()
 
     # add top/bot slice to view post intervention segmentation
     blen = split[drop_end].shape[0]
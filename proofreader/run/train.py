@@ -74,6 +74,9 @@ import json
 @click.option('--ddp',
               type=bool, default=False, help='whether to use distrubited data parallel vs normal data parallel.'
               )
+@click.option('--prefetch', '-p',
+              type=int, default=2, help='batches each dataloader worker loads ahead, workers stay alive across epochs.'
+              )
 def train_wrapper(*args, **kwargs):
     if kwargs['ddp']:
         world_size = torch.cuda.device_count()
@@ -97,7 +100,7 @@ def train_parallel(rank, world_size, kwargs):
 
 def train(config: str, overwrite: bool, path: str, seed: int, output_dir: str, epochs: int, batch_size: int, num_workers: int,
           training_interval: int, validation_interval: int, test_interval: int, test: bool,
-          load: str, ddp: bool, rank: int = 0, world_size: int = 1):
+          load: str, ddp: bool, prefetch: int, rank: int = 0, world_size: int = 1):
 
     print('\nstarting...')
     # seed
@@ -170,13 +173,16 @@ def train(config: str, overwrite: bool, path: str, seed: int, output_dir: str, e
     print('building model...')
     model, loss_module, optimizer, scheduler = build_full_model_from_config(
         config.model, config.dataset, epochs)
+    # clouds come in farthest point order, the sampling models take it instead of sampling themselves
+    use_fps_idx = config.dataset.fps_order and config.model.model in [
+        'curvenet', 'transnet']
 
     # handle GPU and parallelism
     pin_memory = False
     train_sampler, val_sampler, test_sampler = None, None, None
     if config.dataset.balance_samples:
         train_sampler = BalanceClassSampler(
-            list(train_dataset.y[:, 0].numpy()), mode='upsampling')
+            train_dataset.y[:, 0].numpy(), mode='upsampling')
 
     if use_gpu:
         # gpu with DistributedDataParallel
@@ -203,18 +209,29 @@ def train(config: str, overwrite: bool, path: str, seed: int, output_dir: str, e
     print('building dataloader...')
     val_workers = 4
 
-    def collate_info(b):
-        xs, ys, infos = [[t[i] for t in b] for i in range(len(b[0]))]
-        return torch.stack(xs), torch.stack(ys), np.array(infos)
-
-    train_dataloader = DataLoader(dataset=train_dataset, batch_size=batch_size,
-                                  num_workers=num_workers-val_workers, pin_memory=pin_memory, sampler=train_sampler, drop_last=True, shuffle=(train_sampler is None))
-    val_dataloader = DataLoader(dataset=val_dataset, batch_size=batch_size,
-                                num_workers=val_workers, pin_memory=pin_memory, sampler=val_sampler, drop_last=True, shuffle=(val_sampler is None), collate_fn=collate_info)
-    test_dataloader = DataLoader(dataset=test_dataset, batch_size=batch_size,
-                                 num_workers=val_workers, pin_memory=pin_memory, sampler=test_sampler, drop_last=True, shuffle=(test_sampler is None), collate_fn=collate_info)
+    # collate stacks the batch (and its merge info), batched augmentors augment it there
+    # each loader forks its workers once, they keep prefetching across epochs and between the train, val and test phases
+    train_dataloader = None
+    if config.dataset.in_memory:
+        # no workers, every dataset is gathered onto the training device once
+        device = torch.device('cuda', rank) if use_gpu else torch.device('cpu')
+        if not test:
+            train_dataloader = DeviceDataLoader(train_dataset, batch_size, device, sampler=train_sampler,
+                                                shuffle=(train_sampler is None), drop_last=True)
+        val_dataloader = DeviceDataLoader(val_dataset, batch_size, device, sampler=val_sampler,
+                                          shuffle=(val_sampler is None), drop_last=True)
+        test_dataloader = DeviceDataLoader(test_dataset, batch_size, device, sampler=test_sampler,
+                                           shuffle=(test_sampler is None), drop_last=True)
+    else:
+        if not test:
+            train_dataloader = build_persistent_dataloader(train_dataset, num_workers-val_workers, prefetch=prefetch, batch_size=batch_size,
+                                                           pin_memory=pin_memory, sampler=train_sampler, drop_last=True, shuffle=(train_sampler is None), collate_fn=train_dataset.collate)
+        val_dataloader = build_persistent_dataloader(val_dataset, val_workers, prefetch=prefetch, batch_size=batch_size,
+                                                     pin_memory=pin_memory, sampler=val_sampler, drop_last=True, shuffle=(val_sampler is None), collate_fn=val_dataset.collate)
+        test_dataloader = build_persistent_dataloader(test_dataset, val_workers, prefetch=prefetch, batch_size=batch_size,
+                                                      pin_memory=pin_memory, sampler=test_sampler, drop_last=True, shuffle=(test_sampler is None), collate_fn=test_dataset.collate)
 
-    total_train_batches = len(train_dataloader)
+    total_train_batches = 0 if test else len(train_dataloader)
 
     thresholds = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
     print("starting training...")
@@ -228,10 +245,7 @@ def train(config: str, overwrite: bool, path: str, seed: int, output_dir: str, e
         if rank == 0:
             pbar.reset(total=total_train_batches)
             pbar.set_description(f'Training {epoch}')
-        if ddp:
-            train_sampler.set_epoch(epoch)
-            val_sampler.set_epoch(epoch)
-            test_sampler.set_epoch(epoch)
+        # distributed samplers get their epoch from the persistent loaders, see _RepeatSampler
 
         accumulated_loss = 0.0
         all_acc = {}
@@ -250,9 +264,11 @@ def train(config: str, overwrite: bool, path: str, seed: int, output_dir: str, e
                 if use_gpu:
                     x = x.cuda(rank, non_blocking=True)
                     y = y.cuda(rank, non_blocking=True)
+                if getattr(train_dataset.augmentor, 'on_device', False):
+                    x = train_dataset.augmentor(x)
 
                 # foward pass
-                y_hat = model(x)
+                y_hat = model(x, fps_idx=fps_prefix_idx(x)) if use_fps_idx else model(x)
 
                 # compute loss
                 loss = loss_module(y_hat, y)
@@ -304,8 +320,11 @@ def train(config: str, overwrite: bool, path: str, seed: int, output_dir: str, e
                         if use_gpu:
                             x = x.cuda(rank, non_blocking=True)
                             y = y.cuda(rank, non_blocking=True)
+                        if getattr(dataset.augmentor, 'on_device', False):
+                            x = dataset.augmentor(x)
 
-                        y_hat = model(x)
+                        y_hat = model(
+                            x, fps_idx=fps_prefix_idx(x)) if use_fps_idx else model(x)
 
                         # compute loss
                         loss = loss_module(y_hat, y)
@@ -1,17 +1,360 @@
 import h5py
 import os
+import shutil
+import json
+import zlib
+import threading
+import weakref
 import numpy as np
+from multiprocessing import shared_memory
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SlabVolume(object):
+    def __init__(self, shape, dtype, slab_size: int, cache_slabs: int = 8):
+        """
+        A volume which is read on demand, sliced like an ndarray.
+        Reads whole z-slabs (all of y and x) with read(z0, z1) and keeps the last cache_slabs of them.
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slab_size = slab_size
+        self.cache_slabs = cache_slabs
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(self.shape))
+
+        self.slabs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def read(self, z0, z1):
+        raise NotImplementedError
+
+    def __getstate__(self):
+        # cached slabs and anything open stay in their own process
+        state = self.__dict__.copy()
+        state['slabs'] = OrderedDict()
+        state['lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get_slab(self, slab_i):
+        with self.lock:
+            if slab_i in self.slabs:
+                self.slabs.move_to_end(slab_i)
+                return self.slabs[slab_i]
+
+            z0 = slab_i * self.slab_size
+            slab = self.read(z0, min(z0+self.slab_size, self.shape[0]))
+            self.slabs[slab_i] = slab
+            if len(self.slabs) > self.cache_slabs:
+                self.slabs.popitem(last=False)
+            return slab
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        # z indices asked for, same rules as indexing an ndarray
+        zs = np.arange(self.shape[0])[key[0]]
+
+        if np.ndim(zs) == 0:
+            slab_i = zs // self.slab_size
+            res = self.get_slab(slab_i)[(zs - slab_i*self.slab_size,) + key[1:]]
+            return res.copy() if isinstance(res, np.ndarray) else res
+
+        # read each run of z indices which fall in the same slab, only taking the asked y and x
+        empty = np.empty((0,) + self.shape[1:], dtype=self.dtype)
+        parts = [empty[(slice(None),) + key[1:]]]
+        slab_of = zs // self.slab_size
+        for run in np.split(np.arange(len(zs)), np.flatnonzero(np.diff(slab_of)) + 1):
+            if len(run) == 0:
+                continue
+            slab_i = slab_of[run[0]]
+            local = zs[run] - slab_i*self.slab_size
+            parts.append(self.get_slab(slab_i)[(local,) + key[1:]])
+        return np.concatenate(parts)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self.read(0, self.shape[0])
+        return arr if dtype is None else arr.astype(dtype)
+
+    def copy(self):
+        return np.asarray(self)
+
+
+class H5Volume(SlabVolume):
+    def __init__(self, file_name: str, dataset_path: str = '/main', slab_size: int = None, cache_slabs: int = 8):
+        """
+        A volume in an h5 file which is read on demand.
+        slab_size: number of slices per slab, defaults to the z size of the h5 chunks.
+        """
+        self.file_name = file_name
+        self.dataset_path = dataset_path
+
+        with h5py.File(file_name, 'r') as f:
+            dataset = f[dataset_path]
+            (shape, dtype, chunks) = dataset.shape, dataset.dtype, dataset.chunks
+
+        if slab_size is None:
+            slab_size = chunks[0] if chunks is not None else 4
+        super().__init__(shape, dtype, slab_size, cache_slabs=cache_slabs)
+        self.h5 = None
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['h5'] = None
+        return state
+
+    def dataset(self):
+        if self.h5 is None:
+            self.h5 = h5py.File(self.file_name, 'r')
+        return self.h5[self.dataset_path]
+
+    def read(self, z0, z1):
+        return self.dataset()[z0:z1]
+
+
+class SharedVolume(np.ndarray):
+    """
+    An ndarray in named shared memory, see share_volume.
+    Pickles as the name of its memory so DataLoader workers attach to it read only instead of getting a copy.
+    Slices and results of operations on it are plain ndarrays.
+    """
+
+    def __reduce__(self):
+        shm = getattr(self, 'shm', None)
+        if shm is None:
+            return np.asarray(self).__reduce__()
+        return (attach_shared_volume, (shm.name, self.shape, self.dtype.str))
+
+    def __getitem__(self, key):
+        res = super().__getitem__(key)
+        return res.view(np.ndarray) if isinstance(res, np.ndarray) else res
+
+    def __array_wrap__(self, arr, context=None, return_scalar=False):
+        if return_scalar and arr.ndim == 0:
+            return arr[()]
+        return arr.view(np.ndarray)
+
+
+def unlink_shared_memory(shm, pid):
+    # only the process which made the memory removes it, not forked workers
+    if os.getpid() == pid:
+        shm.close()
+        shm.unlink()
+
+
+def share_volume(vol):
+    """
+    Copy vol (an ndarray or lazy volume) into named shared memory, which is removed once the returned
+    SharedVolume is garbage collected. Pickled copies in other processes read the same memory.
+    """
+    vol = np.asarray(vol)
+    shm = shared_memory.SharedMemory(create=True, size=max(vol.nbytes, 1))
+    shared = np.ndarray(vol.shape, dtype=vol.dtype,
+                        buffer=shm.buf).view(SharedVolume)
+    shared[...] = vol
+    shared.flags.writeable = False
+    shared.shm = shm
+    weakref.finalize(shared, unlink_shared_memory, shm, os.getpid())
+    return shared
+
+
+def share_volumes(vols):
+    # memory mapped vols (e.g. the cleaned volume cache) are already shared through the page cache
+    return [v if isinstance(v, (SharedVolume, np.memmap)) else share_volume(v) for v in vols]
+
+
+# memory attached to in this process, by name
+_attached_volumes = {}
+
+
+def attach_shared_volume(name, shape, dtype):
+    if name not in _attached_volumes:
+        try:
+            # the creating process owns the memory
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # before python 3.13, workers share the resource tracker of the creating process
+            shm = shared_memory.SharedMemory(name=name)
+        vol = np.ndarray(shape, dtype=dtype,
+                         buffer=shm.buf).view(SharedVolume)
+        vol.flags.writeable = False
+        vol.shm = shm
+        _attached_volumes[name] = vol
+    return _attached_volumes[name]
+
+
+CHUNKED_HEADER = 'header.json'
+
+
+def chunk_file(path, index):
+    return os.path.join(path, '.'.join(str(i) for i in index))
+
+
+def chunk_grid(shape, chunks):
+    return tuple(int(np.ceil(s / c)) for s, c in zip(shape, chunks))
+
+
+class ChunkedVolume(SlabVolume):
+    def __init__(self, path: str, num_threads: int = None, cache_slabs: int = 8):
+        """
+        A volume stored as a directory of zlib compressed chunks with a json header (see write_chunked_volume).
+        Chunks are read and decompressed concurrently by a thread pool, which unlike h5py is not serialized by a global lock.
+        Slabs are one chunk deep.
+        """
+        self.path = path
+        with open(os.path.join(path, CHUNKED_HEADER)) as f:
+            header = json.load(f)
+        self.chunks = tuple(header['chunks'])
+        self.num_threads = num_threads if num_threads is not None else os.cpu_count()
+        super().__init__(header['shape'], header['dtype'],
+                         self.chunks[0], cache_slabs=cache_slabs)
+        self.pool = None
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['pool'] = None
+        return state
+
+    def read_chunk(self, index, out, z0):
+        # copy the part of chunk index within out, which starts at slice z0
+        start = [i*c for i, c in zip(index, self.chunks)]
+        stop = [min(a + c, n) for a, c, n in zip(start, self.chunks, self.shape)]
+        (za, zb) = max(start[0], z0), min(stop[0], z0 + out.shape[0])
+        region = (slice(za - z0, zb - z0),) + \
+            tuple(slice(a, b) for a, b in zip(start[1:], stop[1:]))
+
+        file_name = chunk_file(self.path, index)
+        if not os.path.exists(file_name):
+            # chunks which are all background are not written
+            out[region] = 0
+            return
+        with open(file_name, 'rb') as f:
+            chunk = np.frombuffer(zlib.decompress(f.read()), dtype=self.dtype)
+        chunk = chunk.reshape([b - a for a, b in zip(start, stop)])
+        out[region] = chunk[za - start[0]:zb - start[0]]
+
+    def read(self, z0, z1):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.num_threads)
+
+        out = np.empty((z1-z0,) + self.shape[1:], dtype=self.dtype)
+        if z1 <= z0:
+            return out
+        grid = chunk_grid(self.shape, self.chunks)
+        indices = [(iz, iy, ix) for iz in range(z0 // self.chunks[0], (z1-1) // self.chunks[0] + 1)
+                   for iy in range(grid[1]) for ix in range(grid[2])]
+        # list to surface any errors from the threads
+        list(self.pool.map(lambda index: self.read_chunk(index, out, z0), indices))
+        return out
+
+
+def write_chunked_volume(path: str, vol, chunks: tuple = (8, 256, 256), level: int = 1, num_threads: int = None):
+    """
+    Write vol (an ndarray, h5 dataset or SlabVolume) as a directory of zlib compressed chunks.
+    vol is read one row of chunks at a time, chunks are compressed and written by a thread pool.
+    The chunks are written to a temporary directory which then replaces path, so a partial conversion is never
+    read and no stale chunks of an earlier conversion are left behind.
+    """
+    path = path.rstrip('/')
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    shape, dtype = tuple(vol.shape), np.dtype(vol.dtype)
+    grid = chunk_grid(shape, chunks)
+
+    def write_chunk(args):
+        (index, chunk) = args
+        if not chunk.any():
+            return
+        with open(chunk_file(tmp_path, index), 'wb') as f:
+            f.write(zlib.compress(np.ascontiguousarray(chunk).tobytes(), level))
+
+    num_threads = num_threads if num_threads is not None else os.cpu_count()
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        for iz in range(grid[0]):
+            slab = np.asarray(vol[iz*chunks[0]:(iz+1)*chunks[0]])
+            tasks = [((iz, iy, ix), slab[:, iy*chunks[1]:(iy+1)*chunks[1], ix*chunks[2]:(ix+1)*chunks[2]])
+                     for iy in range(grid[1]) for ix in range(grid[2])]
+            list(pool.map(write_chunk, tasks))
+
+    header = {'shape': list(shape), 'dtype': dtype.str,
+              'chunks': list(chunks), 'compression': 'zlib'}
+    with open(os.path.join(tmp_path, CHUNKED_HEADER), 'w') as f:
+        json.dump(header, f)
+
+    # a directory can only replace an empty one, so move any earlier conversion aside first
+    old_path = f'{path}.{os.getpid()}.old'
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def chunked_volume_path(file_name: str, dataset_path: str = '/main'):
+    # chunked copy of dataset_path in an h5 file, next to the file
+    return os.path.join(os.path.splitext(file_name)[0] + '.chunks', dataset_path.strip('/'))
+
+
+def convert_h5_to_chunked(file_name: str, dataset_paths=('/main',), chunks: tuple = (8, 256, 256)):
+    """
+    Write a chunked copy of each of dataset_paths in an h5 file next to it, where read_volume will find it.
+    """
+    for dataset_path in dataset_paths:
+        vol = H5Volume(file_name, dataset_path, slab_size=chunks[0])
+        out = chunked_volume_path(file_name, dataset_path)
+        print(f'converting {file_name}:{dataset_path} {vol.shape} to {out}')
+        write_chunked_volume(out, vol, chunks=chunks)
+
+
+def convert_cremi_to_chunked(path: str, chunks: tuple = (8, 256, 256)):
+    """
+    Convert the sample_*.hdf and seg_*.h5 volumes in path to chunked volumes.
+    """
+    for f in sorted(os.listdir(path)):
+        full_path = os.path.join(path, f)
+        if f.startswith('sample_') and f.endswith('.hdf'):
+            with h5py.File(full_path, 'r') as h5:
+                dataset_paths = [d for d in ['volumes/raw',
+                                             'volumes/labels/neuron_ids'] if d in h5]
+            convert_h5_to_chunked(full_path, dataset_paths, chunks=chunks)
+        elif f.startswith('seg_') and f.endswith('.h5'):
+            convert_h5_to_chunked(full_path, ['/main'], chunks=chunks)
+
+
+def read_volume(file_name: str, dataset_path: str = '/main', lazy: bool = False):
+    """
+    Read dataset_path of an h5 file, from its chunked copy when there is one (see convert_h5_to_chunked).
+    lazy: return a volume which is read on demand instead of an ndarray.
+    """
+    chunked_path = chunked_volume_path(file_name, dataset_path)
+    if os.path.exists(os.path.join(chunked_path, CHUNKED_HEADER)):
+        vol = ChunkedVolume(chunked_path)
+        return vol if lazy else np.asarray(vol)
+    return from_h5(file_name, dataset_path=dataset_path, lazy=lazy)
 
 
 def from_h5(file_name: str,
             dataset_path: str = '/main',
-            get_offset: tuple = False):
+            get_offset: tuple = False,
+            lazy: bool = False):
+    """
+    lazy: return a H5Volume which reads the volume on demand instead of an ndarray.
+    """
 
     assert os.path.exists(file_name)
     assert h5py.is_hdf5(file_name)
 
     with h5py.File(file_name, 'r') as f:
-        arr = np.asarray(f[dataset_path])
+        arr = H5Volume(file_name, dataset_path) if lazy else np.asarray(
+            f[dataset_path])
 
         if get_offset:
             offset = f["/annotations"].attrs["offset"]
@@ -23,7 +366,7 @@ def from_h5(file_name: str,
     return arr
 
 
-def read_cremi_volume(volname: str, img: bool = False, seg: bool = False, pad: bool = False, path: str = './dataset'):
+def read_cremi_volume(volname: str, img: bool = False, seg: bool = False, pad: bool = False, path: str = './dataset', lazy: bool = False):
 
     assert img or seg
 
@@ -33,10 +376,10 @@ def read_cremi_volume(volname: str, img: bool = False, seg: bool = False, pad: b
     full_path = os.path.join(path, f'{filename}.hdf')
 
     if img and seg:
-        i = from_h5(full_path, dataset_path='volumes/raw')
-        s = from_h5(full_path, dataset_path='volumes/labels/neuron_ids')
+        i = read_volume(full_path, dataset_path='volumes/raw', lazy=lazy)
+        s = read_volume(full_path, dataset_path='volumes/labels/neuron_ids', lazy=lazy)
         return (i, s)
     if img:
-        return from_h5(full_path, dataset_path='volumes/raw')
+        return read_volume(full_path, dataset_path='volumes/raw', lazy=lazy)
     if seg:
-        return from_h5(full_path, dataset_path='volumes/labels/neuron_ids')
+        return read_volume(full_path, dataset_path='volumes/labels/neuron_ids', lazy=lazy)
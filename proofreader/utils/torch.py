@@ -1,13 +1,15 @@
 import torch
 import gc
 import os
+import random
 from .data import readable_bytes
 from torch.utils.data import DistributedSampler, Dataset
 from torch.utils.data.sampler import Sampler
 from typing import Iterator, List, Optional, Union
 import numpy as np
-from operator import itemgetter
 from .data import equivariant_shuffle
+from proofreader.data.shards import RaggedArray
+from proofreader.data.augment import augment_seed
 
 
 def get_all_live_tensors():
@@ -99,6 +101,13 @@ def load_model(model, path, optimizer=None, map_location=None, strict=True):
     return model
 
 
+def fps_prefix_idx(x):
+    """
+    Farthest point order of a B x C x N batch whose points are already in that order, for the fps_idx of the models.
+    """
+    return torch.arange(x.shape[-1], device=x.device).expand(x.shape[0], -1)
+
+
 def weighted_binary_cross_entropy(output, target, weights=None):
 
     if weights is not None:
@@ -114,37 +123,98 @@ def weighted_binary_cross_entropy(output, target, weights=None):
 
 
 class DatasetWithInfo(torch.utils.data.Dataset):
-    def __init__(self, x, y, info=None, shuffle=False, augmentor=None, stats=None):
+    """
+    x and info may be tensors/lists or lazily read arrays (numpy memmaps, ShardArray).
+    index (optional): row of x and info for each item, so truncation never copies examples, y is per item.
+    seed (optional): item i of epoch e is augmented with augment_seed(seed, e, i), drawn from random if not given.
+                     Items are looked up by i or by (epoch, i), as a MultiEpochsDataLoader does, otherwise epoch is set with set_epoch.
+    """
+
+    def __init__(self, x, y, info=None, shuffle=False, augmentor=None, stats=None, index=None, seed=None):
         if shuffle:
-            x, y = equivariant_shuffle(x, y)
+            if index is not None:
+                index, y = equivariant_shuffle(index, y)
+            else:
+                x, y = equivariant_shuffle(x, y)
         self.x = x
         self.y = y
         self.info = info
+        self.index = index
         self.augmentor = augmentor
         self.stats = stats
+        self.seed = random.randrange(2**31) if seed is None else seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
 
     def __getitem__(self, i):
-        x = self.x[i]
+        epoch = self.epoch
+        if isinstance(i, tuple):
+            (epoch, i) = i
+        seed = augment_seed(self.seed, epoch, i)
+        j = i if self.index is None else self.index[i]
+        x = self.x[j]
         y = self.y[i]
-  
-        if self.augmentor is not None:
+        # copy out of lazily read arrays
+        if not torch.is_tensor(x):
+            x = torch.from_numpy(np.array(x))
+
+        # batched augmentors run in collate instead
+        if self.augmentor is not None and not getattr(self.augmentor, 'batched', False):
             x = x.numpy()
-            x = self.augmentor(x)
+            x = self.augmentor(x, seed=seed)
             x = torch.tensor(x)
+        elif self.augmentor is None and not x.is_floating_point():
+            # compact integer coordinates
+            x = x.float()
+        item = (x, y)
         if self.info is not None:
-            return x, y, self.info[i]
-        return x, y
+            # a MERGE_INFO_DTYPE record, batches of them collate into a structured array
+            item = item + (self.info[j],)
+        if self.augments_at_collate():
+            # seeds the batch in collate
+            item = item + (seed,)
+        return item
+
+    def augments_at_collate(self):
+        return getattr(self.augmentor, 'batched', False) and not self.augmentor.on_device
 
     def __len__(self):
-        return len(self.x)
+        return len(self.y)
+
+    def collate(self, batch):
+        """
+        collate_fn for a DataLoader, stacks x and y and any merge info into a structured array.
+        A batched augmentor (BatchAugmentor) is run on the whole batch here unless it runs on the training device,
+        seeded from the seeds of the batch's items.
+        """
+        xs = [b[0] for b in batch]
+        y = torch.stack([b[1] for b in batch])
+        augmentor = self.augmentor if getattr(
+            self.augmentor, 'batched', False) else None
+        if augmentor is None:
+            x = torch.stack(xs)
+        elif augmentor.on_device:
+            x = augmentor.stack(xs)
+        else:
+            x = augmentor(augmentor.stack(xs), seed=augment_seed(*[b[-1] for b in batch]))
+        if self.info is not None:
+            return x, y, np.array([b[2] for b in batch])
+        return x, y
 
 
 class MultiEpochsDataLoader(torch.utils.data.DataLoader):
+    """
+    DataLoader whose workers are forked once and keep prefetching across epochs, each iteration is one pass of the sampler.
+    Datasets with set_epoch (DatasetWithInfo) are indexed by (epoch, i), the workers' copies never see set_epoch.
+    """
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._DataLoader__initialized = False
-        self.batch_sampler = _RepeatSampler(self.batch_sampler)
+        self.batch_sampler = _RepeatSampler(
+            self.batch_sampler, with_epoch=hasattr(self.dataset, 'set_epoch'))
         self._DataLoader__initialized = True
         self.iterator = super().__iter__()
 
@@ -160,21 +230,138 @@ class _RepeatSampler(object):
     """ Sampler that repeats forever.
     Args:
         sampler (Sampler)
+        with_epoch (bool): yield batches of (epoch, index)
     """
 
-    def __init__(self, sampler):
+    def __init__(self, sampler, with_epoch=False):
         self.sampler = sampler
+        self.with_epoch = with_epoch
 
     def __iter__(self):
+        epoch = 0
         while True:
-            yield from iter(self.sampler)
+            # the next pass is drawn while the last is still prefetching, so
+            # the epoch of a (distributed) sampler is set here rather than by the training loop
+            sampler = getattr(self.sampler, 'sampler', self.sampler)
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(epoch)
+            if self.with_epoch:
+                yield from ([(epoch, i) for i in batch] for batch in self.sampler)
+            else:
+                yield from iter(self.sampler)
+            epoch += 1
+
+
+def build_persistent_dataloader(dataset, num_workers, prefetch=2, **kwargs):
+    """
+    A MultiEpochsDataLoader for dataset, prefetch is the number of batches loaded ahead by each worker.
+    """
+    if num_workers > 0:
+        kwargs['prefetch_factor'] = prefetch
+    return MultiEpochsDataLoader(dataset=dataset, num_workers=num_workers, **kwargs)
+
+
+class DeviceDataLoader(object):
+    """
+    Batches of a DatasetWithInfo held entirely on device, formed by index gather without workers or collate.
+    Augmentation is left to the dataset's on device BatchAugmentor, as with the other loaders.
+    sampler (optional): gives the examples of each epoch, e.g. BalanceClassSampler or DistributedSampler.
+    """
+
+    def __init__(self, dataset, batch_size, device, sampler=None, shuffle=True, drop_last=True, chunk_size=65536):
+        assert dataset.augmentor is None or getattr(dataset.augmentor, 'on_device', False), \
+            'augmentation has to run on device, use a BatchAugmentor with on_device'
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.device = device
+        self.sampler = sampler
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.epoch = 0
+        # row of x and info for each item
+        self.rows = np.arange(len(dataset)) if dataset.index is None else np.asarray(dataset.index)
+        self.x = self.load(chunk_size)
+        self.y = dataset.y.to(device)
+
+    def load(self, chunk_size):
+        """
+        Gather every item's cloud onto the device a chunk at a time, compact integer coordinates stay compact.
+        """
+        x = self.dataset.x
+        ragged = isinstance(x, RaggedArray)
+        if ragged:
+            assert getattr(self.dataset.augmentor, 'fps_order', False), \
+                'full clouds are only kept on device when sampled by farthest point prefix'
+        out = None
+        for s in range(0, len(self.rows), chunk_size):
+            rows = self.rows[s:s + chunk_size]
+            if ragged:
+                chunk = self.dataset.augmentor.stack(
+                    [torch.from_numpy(x[r]) for r in rows])
+            else:
+                chunk = x[rows]
+                if not torch.is_tensor(chunk):
+                    chunk = torch.from_numpy(np.ascontiguousarray(chunk))
+            if out is None:
+                out = torch.empty((len(self.rows),) + chunk.shape[1:],
+                                  dtype=chunk.dtype, device=self.device)
+            out[s:s + len(rows)] = chunk.to(self.device)
+        return out
+
+    def order(self):
+        # the items of one epoch
+        if self.sampler is not None:
+            if hasattr(self.sampler, 'set_epoch'):
+                self.sampler.set_epoch(self.epoch)
+            return torch.from_numpy(sampler_indices(self.sampler)).to(self.device)
+        if self.shuffle:
+            return torch.randperm(len(self.rows), device=self.device)
+        return torch.arange(len(self.rows), device=self.device)
+
+    def __len__(self):
+        n = len(self.rows) if self.sampler is None else len(self.sampler)
+        if self.drop_last:
+            return n // self.batch_size
+        return (n + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        order = self.order()
+        self.epoch += 1
+        for b in range(len(self)):
+            i = order[b * self.batch_size:(b + 1) * self.batch_size]
+            x = self.x[i]
+            if self.dataset.augmentor is None and not x.is_floating_point():
+                # compact integer coordinates
+                x = x.float()
+            y = self.y[i]
+            if self.dataset.info is not None:
+                yield x, y, self.dataset.info[self.rows[i.cpu().numpy()]]
+            else:
+                yield x, y
+
+
+def iter_indices(indices, chunk_size=65536):
+    """
+    Iterate an int64 index array as python ints, a chunk at a time rather than converting the whole epoch to a list.
+    """
+    for s in range(0, len(indices), chunk_size):
+        yield from indices[s:s + chunk_size].tolist()
+
+
+def sampler_indices(sampler):
+    """
+    The indices of one pass over sampler as an int64 array, samplers with indices() build it without iterating.
+    """
+    if hasattr(sampler, 'indices'):
+        return sampler.indices()
+    return np.fromiter(iter(sampler), dtype=np.int64, count=len(sampler))
 
 
 # https://github.com/catalyst-team/catalyst/blob/master/catalyst/data/sampler.py#L135
 class BalanceClassSampler(Sampler):
     """Allows you to create stratified sample on unbalanced classes.
     Args:
-        labels: list of class label for each elem in the dataset
+        labels: class label for each elem in the dataset, a list or array
         mode: Strategy to balance classes.
             Must be one of [downsampling, upsampling]
     Python API examples:
@@ -214,15 +401,14 @@ class BalanceClassSampler(Sampler):
 
     def __init__(self, labels: List[int], mode: Union[str, int] = "downsampling"):
         """Sampler initialisation."""
-        super().__init__(labels)
-
-        labels = np.array(labels)
-        samples_per_class = {label: (labels == label).sum()
-                             for label in set(labels)}
-
+        # Sampler.__init__ does nothing, and newer torch no longer takes data_source
+        labels = np.asarray(labels)
+        # indices of each class as int64 arrays
         self.lbl2idx = {
-            label: np.arange(len(labels))[labels == label].tolist() for label in set(labels)
+            label.item(): np.flatnonzero(labels == label) for label in np.unique(labels)
         }
+        samples_per_class = {label: len(idx)
+                             for label, idx in self.lbl2idx.items()}
 
         if isinstance(mode, str):
             assert mode in ["downsampling", "upsampling"]
@@ -235,23 +421,34 @@ class BalanceClassSampler(Sampler):
 
         self.labels = labels
         self.samples_per_class = samples_per_class
-        self.length = self.samples_per_class * len(set(labels))
+        self.length = self.samples_per_class * len(self.lbl2idx)
 
-    def __iter__(self) -> Iterator[int]:
+    def indices(self) -> np.ndarray:
         """
-        Yields:
-            indices of stratified sample
+        Returns:
+            int64 array of the indices of a stratified sample
         """
-        indices = []
-        for key in sorted(self.lbl2idx):
+        indices = np.empty(self.length, dtype=np.int64)
+        for i, key in enumerate(sorted(self.lbl2idx)):
+            out = indices[i * self.samples_per_class:(i + 1) * self.samples_per_class]
+            if self.samples_per_class == len(self.lbl2idx[key]):
+                # all of the class, its order does not matter since everything is shuffled below
+                out[:] = self.lbl2idx[key]
+                continue
             replace_flag = self.samples_per_class > len(self.lbl2idx[key])
-            indices += np.random.choice(
+            out[:] = np.random.choice(
                 self.lbl2idx[key], self.samples_per_class, replace=replace_flag
-            ).tolist()
-        assert len(indices) == self.length
+            )
         np.random.shuffle(indices)
 
-        return iter(indices)
+        return indices
+
+    def __iter__(self) -> Iterator[int]:
+        """
+        Yields:
+            indices of stratified sample
+        """
+        return iter_indices(self.indices())
 
     def __len__(self) -> int:
         """
@@ -303,10 +500,21 @@ class DistributedSamplerWrapper(DistributedSampler):
         Returns:
             python iterator
         """
-        self.dataset = DatasetFromSampler(self.sampler)
-        indexes_of_indexes = super().__iter__()
-        subsampler_indexes = self.dataset
-        return iter(itemgetter(*indexes_of_indexes)(subsampler_indexes))
+        # same split as DistributedSampler.__iter__, on arrays
+        subsampler_indexes = sampler_indices(self.sampler)
+        n = len(subsampler_indexes)
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indexes_of_indexes = torch.randperm(n, generator=g).numpy()
+        else:
+            indexes_of_indexes = np.arange(n, dtype=np.int64)
+        # padding repeats the indices from the start, resize does the same
+        indexes_of_indexes = np.resize(indexes_of_indexes, self.total_size)
+        indexes_of_indexes = indexes_of_indexes[self.rank:self.total_size:self.num_replicas]
+        assert len(indexes_of_indexes) == self.num_samples
+
+        return iter_indices(subsampler_indexes[indexes_of_indexes])
 
 
 class DatasetFromSampler(Dataset):
@@ -318,7 +526,7 @@ class DatasetFromSampler(Dataset):
     def __init__(self, sampler: Sampler):
         """Initialisation for DatasetFromSampler."""
         self.sampler = sampler
-        self.sampler_list = None
+        self.sampler_indices = None
 
     def __getitem__(self, index: int):
         """Gets element of the dataset.
@@ -327,9 +535,9 @@ class DatasetFromSampler(Dataset):
         Returns:
             Single element by index
         """
-        if self.sampler_list is None:
-            self.sampler_list = list(self.sampler)
-        return self.sampler_list[index]
+        if self.sampler_indices is None:
+            self.sampler_indices = sampler_indices(self.sampler)
+        return self.sampler_indices[index].item()
 
     def __len__(self) -> int:
         """